@@ -1,8 +1,9 @@
 from flask import Flask, request, abort
-import json
+import os
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from jwks_cache import JWKSCache, TokenCache
 
 
 app = Flask(__name__)
@@ -11,6 +12,10 @@ AUTH0_DOMAIN = @TODO_REPLACE_WITH_YOUR_DOMAIN
 ALGORITHMS = ['RS256']
 API_AUDIENCE = @TODO_REPLACE_WITH_YOUR_API_AUDIENCE
 
+# JWKS_URL can point at a local file (file:///path/to/jwks.json) or stub server for testing
+jwks_cache = JWKSCache(os.getenv('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'))
+token_cache = TokenCache()
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -52,25 +57,18 @@ def get_token_auth_header():
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -81,6 +79,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            token_cache.put(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.request import urlopen
+
+
+class JWKSCache:
+    """Keeps the signing keys of a JWKS endpoint in memory, keyed by kid.
+
+    Keys are refreshed in a background thread shortly before they expire,
+    and the endpoint is only fetched inline the first time or when a token
+    names a kid we do not know (at most once per min_refetch_interval).
+    If a refresh fails the old keys stay in use, so an identity provider
+    outage does not fail every request.
+
+    url can be any URL urlopen understands, including file:// for tests.
+    """
+
+    def __init__(self, url, ttl=600, refresh_ahead=60, min_refetch_interval=10,
+                 fetch=None, clock=time.time):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_refetch_interval = min_refetch_interval
+        self.fetch = fetch or self._fetch
+        self.clock = clock
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=5) as response:
+            return json.loads(response.read())
+
+    def _load(self):
+        self._last_attempt = self.clock()
+        jwks = self.fetch()
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        self._keys = keys
+        self._fetched_at = self.clock()
+
+    def _refresh_in_background(self):
+        def refresh():
+            with self._lock:
+                try:
+                    self._load()
+                except Exception:
+                    pass
+                finally:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_key(self, kid):
+        """Returns the RSA key for kid, or None if the endpoint does not know it either."""
+        if self._fetched_at is None:
+            with self._lock:
+                if self._fetched_at is None:
+                    self._load()
+        age = self.clock() - self._fetched_at
+        if age >= self.ttl - self.refresh_ahead and not self._refreshing:
+            # check and set under the lock, or two requests could both start a refresh
+            with self._lock:
+                start = (not self._refreshing
+                         and self.clock() - self._last_attempt >= self.min_refetch_interval)
+                if start:
+                    self._refreshing = True
+            if start:
+                self._refresh_in_background()
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        with self._lock:
+            key = self._keys.get(kid)
+            if key is None and self.clock() - self._last_attempt >= self.min_refetch_interval:
+                self._load()
+                key = self._keys.get(kid)
+        return key
+
+
+class TokenCache:
+    """A bounded LRU of verified token payloads, keyed by the SHA-256 of the token.
+
+    A payload is only returned while its exp claim is in the future, so a
+    cached token expires exactly when the token itself does.
+    """
+
+    def __init__(self, max_size=1024, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        digest = self.digest(token)
+        with self._lock:
+            payload = self._entries.get(digest)
+            if payload is None:
+                return None
+            if payload['exp'] <= self.clock():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return payload
+
+    def put(self, token, payload):
+        if not isinstance(payload.get('exp'), (int, float)):
+            return
+        digest = self.digest(token)
+        with self._lock:
+            self._entries[digest] = payload
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
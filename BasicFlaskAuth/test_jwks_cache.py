@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from jwks_cache import JWKSCache, TokenCache
+
+
+class Clock:
+    """A clock the tests move by hand."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class tests JWKSCache against a local JWKS file"""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'jwks.json')
+        self.write_keys('first')
+        self.clock = Clock()
+        self.cache = JWKSCache('file://' + self.path, ttl=600, refresh_ahead=60,
+                               min_refetch_interval=10, clock=self.clock)
+
+    def write_keys(self, *kids):
+        with open(self.path, 'w') as f:
+            json.dump({'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n-' + kid, 'e': 'AQAB'}
+                                for kid in kids]}, f)
+
+    def wait_for_refresh(self):
+        deadline = time.time() + 5
+        while self.cache._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.cache._refreshing)
+
+    def test_KeysServedFromMemoryWithinTTL(self):
+        self.assertEqual(self.cache.get_key('first')['n'], 'n-first')
+        self.write_keys('second')
+        self.clock.now += 500
+
+        self.assertEqual(self.cache.get_key('first')['n'], 'n-first')
+        self.assertFalse(self.cache._refreshing)
+
+    def test_RefreshesInBackgroundBeforeTTL(self):
+        self.cache.get_key('first')
+        self.write_keys('second')
+        self.clock.now += 545
+
+        # the old keys answer while the refresh runs
+        self.assertEqual(self.cache.get_key('first')['n'], 'n-first')
+        self.wait_for_refresh()
+        self.assertEqual(self.cache._fetched_at, self.clock.now)
+        self.assertEqual(self.cache.get_key('second')['n'], 'n-second')
+        self.assertIsNone(self.cache.get_key('first'))
+
+    def test_FailedRefreshKeepsOldKeys(self):
+        self.cache.get_key('first')
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.clock.now += 600
+
+        self.assertEqual(self.cache.get_key('first')['n'], 'n-first')
+        self.wait_for_refresh()
+        self.assertEqual(self.cache.get_key('first')['n'], 'n-first')
+
+    def test_UnknownKidRefetchIsRateLimited(self):
+        self.cache.get_key('first')
+        self.write_keys('first', 'rotated')
+        self.clock.now += 5
+
+        self.assertIsNone(self.cache.get_key('rotated'))
+        self.clock.now += 5
+        self.assertEqual(self.cache.get_key('rotated')['n'], 'n-rotated')
+        self.assertIsNone(self.cache.get_key('unknown'))
+        self.write_keys('first', 'rotated', 'unknown')
+        self.assertIsNone(self.cache.get_key('unknown'))
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class tests TokenCache"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TokenCache(max_size=2, clock=self.clock)
+
+    def test_TokenExpiresAtExp(self):
+        self.cache.put('token', {'sub': 'user', 'exp': self.clock.now + 60})
+        self.clock.now += 59
+        self.assertEqual(self.cache.get('token')['sub'], 'user')
+
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(len(self.cache._entries), 0)
+
+    def test_TokenWithoutExpNotCached(self):
+        self.cache.put('token', {'sub': 'user'})
+
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_LeastRecentlyUsedTokenEvicted(self):
+        exp = self.clock.now + 60
+        self.cache.put('a', {'sub': 'a', 'exp': exp})
+        self.cache.put('b', {'sub': 'b', 'exp': exp})
+        self.cache.get('a')
+        self.cache.put('c', {'sub': 'c', 'exp': exp})
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a')['sub'], 'a')
+        self.assertEqual(self.cache.get('c')['sub'], 'c')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,8 @@
+'''
+ASGI entry point, serve the async variant of the API with:
+
+    uvicorn asgi:app --workers 4
+'''
+from flaskr.asgi import create_asgi_app
+
+app = create_asgi_app()
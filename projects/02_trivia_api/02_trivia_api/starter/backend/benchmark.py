@@ -0,0 +1,315 @@
+'''
+Load test and benchmark for the trivia API.
+
+Seeds a database with generated questions, then drives the read endpoints through the
+Flask test client and through a real threaded WSGI server at several concurrency levels,
+and prints latency percentiles and requests/sec as JSON:
+
+    python benchmark.py --questions 20000 --concurrency 1,8,32 --output before.json
+
+--room-players N also fills one multiplayer room with N players listening to its event stream
+and answering every question, and times how long each question takes to reach every player:
+
+    python benchmark.py --targets wsgi --room-players 500 --room-rounds 10
+
+The database is a temporary SQLite file unless --database-url names another one
+(for example a local Postgres: postgresql://postgres@localhost:5432/trivia_bench).
+It is dropped and recreated, so never point it at a database you want to keep.
+'''
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from werkzeug.serving import make_server
+
+from flaskr import create_app
+from models import db, Question, Category
+
+WORDS = ('river', 'mountain', 'painter', 'planet', 'empire', 'novel', 'goal', 'league', 'element',
+         'ocean', 'composer', 'battle', 'desert', 'island', 'film', 'actor', 'player', 'king')
+
+
+'''
+seed(app, questions, categories)
+    recreates the tables and fills them with generated rows, in batches
+'''
+def seed(app, questions, categories, batch_size=5000):
+  rng = random.Random(0)
+  with app.app_context():
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Category.__table__.insert(),
+                       [{'id': i, 'type': 'Category {}'.format(i)} for i in range(1, categories + 1)])
+    for start in range(0, questions, batch_size):
+      rows = []
+      for i in range(start, min(start + batch_size, questions)):
+        words = ' '.join(rng.choice(WORDS) for _ in range(6))
+        rows.append({
+          'question': 'Question {} about the {}?'.format(i, words),
+          'answer': rng.choice(WORDS),
+          'category': rng.randint(1, categories),
+          'difficulty': rng.randint(1, 5)
+        })
+      db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+
+
+'''
+scenarios(questions, categories)
+    the requests to time: (name, method, path, json body factory)
+'''
+def scenarios(questions, categories):
+  pages = max(questions // 10, 1)
+  return [
+    ('GET /categories', 'GET', lambda rng: '/categories', None),
+    ('GET /questions', 'GET', lambda rng: '/questions?page={}'.format(rng.randint(1, pages)), None),
+    ('GET /categories/<id>/questions', 'GET',
+     lambda rng: '/categories/{}/questions'.format(rng.randint(1, categories)), None),
+    ('POST /questions/search', 'POST', lambda rng: '/questions/search',
+     lambda rng: {'searchTerm': rng.choice(WORDS), 'currentCategory': None}),
+    ('POST /quizzes', 'POST', lambda rng: '/quizzes',
+     lambda rng: {'quiz_category': {'id': rng.randint(0, categories)},
+                  'previous_questions': [rng.randint(1, questions) for _ in range(5)]}),
+  ]
+
+
+def current_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                   cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def percentile(samples, fraction):
+  index = min(int(round(fraction * (len(samples) - 1))), len(samples) - 1)
+  return samples[index]
+
+
+'''
+run(send, scenario, requests, concurrency)
+    sends requests in concurrency threads, each with its own client from send(),
+    and returns the latency percentiles in milliseconds and the throughput
+'''
+def run(send, scenario, requests, concurrency):
+  name, method, path, body = scenario
+  per_thread = max(requests // concurrency, 1)
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+
+  def worker(seed):
+    rng = random.Random(seed)
+    request = send()
+    timings = []
+    failed = 0
+    for _ in range(per_thread):
+      payload = body(rng) if body else None
+      start = time.perf_counter()
+      status = request(method, path(rng), payload)
+      timings.append(time.perf_counter() - start)
+      if status >= 400:
+        failed += 1
+    with lock:
+      latencies.extend(timings)
+      errors[0] += failed
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(concurrency) as pool:
+    list(pool.map(worker, range(concurrency)))
+  elapsed = time.perf_counter() - started
+  latencies.sort()
+  return {
+    'endpoint': name,
+    'concurrency': concurrency,
+    'requests': len(latencies),
+    'errors': errors[0],
+    'rps': round(len(latencies) / elapsed, 1),
+    'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+    'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+    'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)
+  }
+
+
+def client_sender(app):
+  def send():
+    client = app.test_client()
+
+    def request(method, path, payload):
+      return client.open(path, method=method, json=payload).status_code
+    return request
+  return send
+
+
+def wsgi_sender(base_url):
+  def send():
+    def request(method, path, payload):
+      data = json.dumps(payload).encode('utf-8') if payload is not None else None
+      http_request = Request(base_url + path, data=data, method=method,
+                             headers={'Content-Type': 'application/json'})
+      try:
+        with urlopen(http_request) as response:
+          response.read()
+          return response.status
+      except Exception as error:
+        return getattr(error, 'code', 599)
+    return request
+  return send
+
+
+'''
+room_fanout(app, base_url, players, rounds)
+    joins players to one room over real HTTP, each with its own event stream, moves the room through
+    rounds questions and returns the latency percentiles from the host's request to each player
+    receiving the question. every player answers each question it receives, and the host moves on
+    once every player has the question
+'''
+def room_fanout(app, base_url, players, rounds, timeout=30, connecting=64):
+  # more simultaneous connects than the server's listen backlog get reset, which is not what this measures
+  connections = threading.BoundedSemaphore(connecting)
+
+  def call(path, payload):
+    http_request = Request(base_url + path, data=json.dumps(payload).encode('utf-8'), method='POST',
+                           headers={'Content-Type': 'application/json'})
+    with connections, urlopen(http_request) as response:
+      return json.loads(response.read())
+
+  def listen(path):
+    with connections:
+      return urlopen(base_url + path, timeout=timeout)
+
+  room = call('/rooms', {'quiz_category': {'id': 0}})
+  room_id = room['room_id']
+  sent = {}
+  latencies = []
+  received = dict((r, 0) for r in range(1, rounds + 1))
+  delivered = threading.Condition()
+
+  def play(number):
+    player = call('/rooms/{}/players'.format(room_id), {'name': 'player {}'.format(number)})
+    with listen('/rooms/{}/events'.format(room_id)) as response:
+      question = False
+      for line in response:
+        if line.startswith(b'event: '):
+          question = line.strip() == b'event: question'
+        elif question and line.startswith(b'data: '):
+          arrived = time.perf_counter()
+          round_number = json.loads(line[6:])['round']
+          with delivered:
+            latencies.append(arrived - sent[round_number])
+            received[round_number] += 1
+            delivered.notify_all()
+          try:
+            call('/rooms/{}/answers'.format(room_id),
+                 {'player_token': player['player_token'], 'round': round_number, 'answer': 'benchmark'})
+          except HTTPError:
+            # 409 when the host moved on before this answer arrived
+            pass
+          if round_number == rounds:
+            return
+
+  threads = [threading.Thread(target=play, args=(number,), daemon=True) for number in range(players)]
+  for thread in threads:
+    thread.start()
+  deadline = time.time() + timeout
+  while app.rooms.get(room_id).subscribers < players and time.time() < deadline:
+    time.sleep(0.01)
+  started = time.perf_counter()
+  for round_number in range(1, rounds + 1):
+    sent[round_number] = time.perf_counter()
+    call('/rooms/{}/next'.format(room_id), {'host_token': room['host_token']})
+    with delivered:
+      delivered.wait_for(lambda: received[round_number] >= players, max(deadline - time.time(), 0))
+  elapsed = time.perf_counter() - started
+  for thread in threads:
+    thread.join(1)
+  latencies.sort()
+  return {
+    'endpoint': 'room fan-out',
+    'players': players,
+    'rounds': rounds,
+    'delivered': len(latencies),
+    'rounds_per_second': round(rounds / elapsed, 1),
+    'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+    'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+    'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    'max_ms': round(latencies[-1] * 1000, 3) if latencies else None
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--database-url', help='database to seed and use (default: a temporary SQLite file)')
+  parser.add_argument('--questions', type=int, default=10000)
+  parser.add_argument('--categories', type=int, default=6)
+  parser.add_argument('--requests', type=int, default=1000, help='requests per endpoint and concurrency level')
+  parser.add_argument('--concurrency', default='1,8,32', help='comma separated thread counts')
+  parser.add_argument('--targets', default='client,wsgi', help='client, wsgi or both')
+  parser.add_argument('--room-players', type=int, default=0, help='players of the room fan-out test (wsgi target)')
+  parser.add_argument('--room-rounds', type=int, default=5)
+  parser.add_argument('--output', help='write the JSON report here instead of stdout')
+  args = parser.parse_args(argv)
+
+  database_url = args.database_url
+  if database_url is None:
+    database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'trivia_bench.db')
+  # every request comes from one address, and measuring overload is the point
+  app = create_app({'SQLALCHEMY_DATABASE_URI': database_url, 'RATE_LIMIT_ENABLED': False})
+  seed(app, args.questions, args.categories)
+
+  report = {
+    'commit': current_commit(),
+    'database': database_url.split('@')[-1],
+    'questions': args.questions,
+    'categories': args.categories,
+    'startup': app.startup_report,
+    'results': []
+  }
+  levels = [int(level) for level in args.concurrency.split(',')]
+  targets = args.targets.split(',')
+  for target in targets:
+    if target == 'client':
+      send = client_sender(app)
+    elif target == 'wsgi':
+      logging.getLogger('werkzeug').setLevel(logging.ERROR)
+      server = make_server('127.0.0.1', 0, app, threaded=True)
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+      send = wsgi_sender('http://127.0.0.1:{}'.format(server.server_port))
+    else:
+      parser.error('unknown target {}'.format(target))
+    for scenario in scenarios(args.questions, args.categories):
+      for level in levels:
+        result = run(send, scenario, args.requests, level)
+        result['target'] = target
+        report['results'].append(result)
+        print('{target:6} {endpoint:32} c={concurrency:<3} {rps:>9} req/s  p50={p50_ms}ms p99={p99_ms}ms'.format(**result),
+              file=sys.stderr)
+    if target == 'wsgi':
+      if args.room_players:
+        result = room_fanout(app, 'http://127.0.0.1:{}'.format(server.server_port), args.room_players,
+                             args.room_rounds)
+        result['target'] = target
+        report['results'].append(result)
+        print('{target:6} {endpoint:32} n={players:<4} {delivered} delivered  p50={p50_ms}ms p99={p99_ms}ms'
+              .format(**result), file=sys.stderr)
+      server.shutdown()
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+
+if __name__ == '__main__':
+  main()
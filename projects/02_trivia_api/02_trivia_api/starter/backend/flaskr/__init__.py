@@ -1,17 +1,164 @@
+import time
+_import_started = time.perf_counter()
+
+import json
 import os
-from flask import Flask, request, abort, jsonify
+import click
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS,cross_origin
-import random
-
-from models import setup_db, Question, Category
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import select
+
+from models import setup_db, database_path, db, Question, Category, CREATE_TABLES
+from .pagination import decode_cursor, paginate_questions
+from .category_cache import CategoryCache, CATEGORY_CACHE_TTL, CATEGORY_VERSION_FILE
+from .quiz import QuestionIdIndex, QUESTION_INDEX_TTL, QUESTION_VERSION_FILE, MAX_QUIZ_DRAW, target_difficulty
+from .quiz_sessions import QuizSession, create_session_store
+from .search import PostgresSearch, SearchResultCache, SEARCH_CACHE_SIZE, create_search, tokenize
+from .stats import QuestionStats, STATS_TTL
+from .autocomplete import PrefixIndex, AUTOCOMPLETE_LIMIT
+from .http_cache import ResponseCache, RESPONSE_CACHE_MAX_AGE, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+from .bulk import FORMATS, import_questions, export_questions
+from .metrics import Metrics
+from .pool import engine_options, pool_stats
+from .serialization import (STREAM_THRESHOLD, STREAM_BATCH_SIZE, question_rows, question_rows_by_id, question_ids,
+                            format_row, json_response, stream_questions)
+from .rate_limit import RateLimiter, RATE_LIMIT_ENABLED, LOAD_SHED_MAX_IN_FLIGHT, PROXY_FIX_HOPS, create_bucket_store
+from .replicas import ReplicaRouter, REPLICA_STRATEGY, REPLICA_STICKY_SECONDS, keep_routing, on_primary, served_by_replica
+from .startup import StartupReport, PRELOAD_CACHES, preload_caches
+from .snapshot import SnapshotStore, SNAPSHOT_ENABLED, SNAPSHOT_PATH, SNAPSHOT_TTL
+from .group_commit import GroupCommitter, GROUP_COMMIT_ENABLED, GROUP_COMMIT_DELAY_MS, GROUP_COMMIT_MAX_BATCH
+from .rooms import (Room, RoomStore, stream_room, ROOM_MAX, ROOM_TTL, ROOM_KEEPALIVE_SECONDS, ROOM_STREAM_SECONDS,
+                    MAX_PLAYER_NAME)
+from .sync import changes_since, stream_changes, SYNC_POLL_INTERVAL_MS, SYNC_KEEPALIVE_SECONDS, SYNC_STREAM_SECONDS
 
 QUESTIONS_PER_PAGE = 10
+# the most ids one /questions/batch call may ask for
+MAX_BATCH_IDS = 100
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+# seconds the first import of this package took, including the dependencies it loaded
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
 def create_app(test_config=None):
   # create and configure the app
+  startup = StartupReport(IMPORT_SECONDS)
   app = Flask(__name__)
-  setup_db(app)
+  app.config['CATEGORY_CACHE_TTL'] = int(os.getenv('CATEGORY_CACHE_TTL', CATEGORY_CACHE_TTL))
+  app.config['CATEGORY_VERSION_FILE'] = os.getenv('CATEGORY_VERSION_FILE', CATEGORY_VERSION_FILE)
+  app.config['QUESTION_INDEX_TTL'] = int(os.getenv('QUESTION_INDEX_TTL', QUESTION_INDEX_TTL))
+  app.config['QUESTION_VERSION_FILE'] = os.getenv('QUESTION_VERSION_FILE', QUESTION_VERSION_FILE)
+  for key in ('QUIZ_SESSION_STORE', 'QUIZ_SESSION_DB', 'SEARCH_BACKEND', 'DB_REPLICA_STRATEGY', 'RATE_LIMIT_STORE',
+              'RATE_LIMIT_DB', 'DB_CREATE_TABLES', 'SNAPSHOT_PATH'):
+    if os.getenv(key):
+      app.config[key] = os.getenv(key)
+  for key in ('QUIZ_SESSION_MAX', 'QUIZ_SESSION_TTL', 'SEARCH_INDEX_TTL', 'SEARCH_CACHE_SIZE',
+              'RESPONSE_CACHE_MAX_AGE', 'RESPONSE_CACHE_SIZE', 'RESPONSE_CACHE_TTL', 'DB_POOL_SIZE', 'DB_MAX_OVERFLOW',
+              'DB_POOL_TIMEOUT', 'DB_POOL_RECYCLE', 'DB_CONNECT_TIMEOUT', 'DB_STATEMENT_TIMEOUT',
+              'DB_REPLICA_STICKY_SECONDS', 'RATE_LIMIT_MAX_KEYS', 'LOAD_SHED_MAX_IN_FLIGHT', 'GROUP_COMMIT_DELAY_MS',
+              'GROUP_COMMIT_MAX_BATCH', 'SYNC_POLL_INTERVAL_MS', 'SYNC_KEEPALIVE_SECONDS', 'SYNC_STREAM_SECONDS',
+              'ROOM_MAX', 'ROOM_TTL', 'ROOM_KEEPALIVE_SECONDS', 'ROOM_STREAM_SECONDS', 'PROXY_FIX_HOPS',
+              'SNAPSHOT_TTL', 'STREAM_THRESHOLD', 'STREAM_BATCH_SIZE'):
+    if os.getenv(key):
+      app.config[key] = int(os.getenv(key))
+  for key in ('METRICS_ENABLED', 'PROFILING_ENABLED', 'DB_POOL_PRE_PING', 'RATE_LIMIT_ENABLED',
+              'MIGRATIONS_ENABLED', 'PRELOAD_CACHES', 'SNAPSHOT_ENABLED', 'GROUP_COMMIT_ENABLED'):
+    if os.getenv(key):
+      app.config[key] = os.getenv(key).lower() in ('1', 'true', 'yes')
+  if os.getenv('DB_REPLICA_URLS'):
+    app.config['DB_REPLICA_URLS'] = [url for url in os.getenv('DB_REPLICA_URLS').split(',') if url]
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  startup.mark('config')
+  database_uri = app.config.get('SQLALCHEMY_DATABASE_URI', database_path)
+  migrations = app.config.get('MIGRATIONS_ENABLED', os.getenv('FLASK_RUN_FROM_CLI') == 'true')
+  # an app that runs the migrations must start on the database they are about to upgrade, and
+  # leave the schema to them: create_all() would add tables the migrations then skip
+  created = setup_db(app, database_uri, engine_options(app.config, database_uri),
+                     'never' if migrations else app.config.get('DB_CREATE_TABLES', CREATE_TABLES),
+                     require_schema=not migrations)
+  startup.note('createAll', created)
+  # alembic is a large import that only the `flask db` commands need
+  if migrations:
+    from flask_migrate import Migrate
+    Migrate(app, db, directory=MIGRATIONS_DIRECTORY)
+  startup.mark('database')
+  category_cache = CategoryCache(ttl=app.config['CATEGORY_CACHE_TTL'],
+                                 version_file=app.config['CATEGORY_VERSION_FILE'])
+  app.category_cache = category_cache
+  question_index = QuestionIdIndex(ttl=app.config['QUESTION_INDEX_TTL'],
+                                   version_file=app.config['QUESTION_VERSION_FILE'])
+  app.question_index = question_index
+  quiz_sessions = create_session_store(app.config)
+  app.quiz_sessions = quiz_sessions
+  rooms = RoomStore(app.config.get('ROOM_MAX', ROOM_MAX), app.config.get('ROOM_TTL', ROOM_TTL))
+  app.rooms = rooms
+  search = create_search(app.config)
+  if isinstance(search, PostgresSearch):
+    # in an app context of its own, so the session is removed after it instead of being reused by the next app
+    with app.app_context():
+      try:
+        search.ensure_index()
+      except Exception:
+        db.session.rollback()
+        app.logger.warning('could not create the full-text search index, searches will scan the table')
+  app.search = search
+  search_cache = SearchResultCache(size=app.config.get('SEARCH_CACHE_SIZE', SEARCH_CACHE_SIZE),
+                                   version_file=app.config['QUESTION_VERSION_FILE'])
+  app.search_cache = search_cache
+  prefix_index = PrefixIndex(version_file=app.config['QUESTION_VERSION_FILE'])
+  app.prefix_index = prefix_index
+  question_stats = QuestionStats(ttl=app.config.get('STATS_TTL', STATS_TTL),
+                                 version_file=app.config['QUESTION_VERSION_FILE'])
+  app.question_stats = question_stats
+  # every committed question or category write bumps one of these files
+  response_cache = ResponseCache(
+    lambda: (question_index.version_file.value(), category_cache.version_file.value()),
+    max_age=app.config.get('RESPONSE_CACHE_MAX_AGE', RESPONSE_CACHE_MAX_AGE),
+    size=app.config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE),
+    ttl=app.config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL))
+  app.response_cache = response_cache
+  metrics = Metrics()
+  metrics.init_app(app)
+  app.metrics = metrics
+  replica_router = ReplicaRouter(app.config.get('DB_REPLICA_URLS', ()),
+                                 strategy=app.config.get('DB_REPLICA_STRATEGY', REPLICA_STRATEGY),
+                                 sticky_seconds=app.config.get('DB_REPLICA_STICKY_SECONDS', REPLICA_STICKY_SECONDS),
+                                 config=app.config)
+  replica_router.init_app(app)
+  proxy_hops = app.config.get('PROXY_FIX_HOPS', PROXY_FIX_HOPS)
+  if proxy_hops:
+    # take the client address and scheme from the headers the trusted proxies set
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops)
+  if app.config.get('RATE_LIMIT_ENABLED', RATE_LIMIT_ENABLED):
+    rate_limiter = RateLimiter(create_bucket_store(app.config), app.config.get('RATE_LIMITS'),
+                               app.config.get('LOAD_SHED_MAX_IN_FLIGHT', LOAD_SHED_MAX_IN_FLIGHT))
+    rate_limiter.init_app(app)
+    app.rate_limiter = rate_limiter
+  snapshots = None
+  if app.config.get('SNAPSHOT_ENABLED', SNAPSHOT_ENABLED):
+    snapshots = SnapshotStore(app.config.get('SNAPSHOT_PATH', SNAPSHOT_PATH), app.config['QUESTION_VERSION_FILE'],
+                              app.config['CATEGORY_VERSION_FILE'], app.config.get('SNAPSHOT_TTL', SNAPSHOT_TTL))
+    snapshots.init_app(app)
+  group_commit = None
+  if app.config.get('GROUP_COMMIT_ENABLED', GROUP_COMMIT_ENABLED):
+    group_commit = GroupCommitter(app.config.get('GROUP_COMMIT_DELAY_MS', GROUP_COMMIT_DELAY_MS),
+                                  app.config.get('GROUP_COMMIT_MAX_BATCH', GROUP_COMMIT_MAX_BATCH))
+    app.group_commit = group_commit
+  startup.mark('services')
+
+  def write(operation):
+    # operation() changes db.session, committed with other requests' writes when group commit is on
+    if group_commit is not None:
+      return group_commit.submit(operation)
+    result = operation()
+    db.session.commit()
+    return result
+
+  def current_snapshot():
+    # the shared question snapshot when it is enabled and up to date, None to read the database
+    return snapshots.current() if snapshots is not None else None
 
   
   '''
@@ -43,14 +190,12 @@ def create_app(test_config=None):
 
   @app.route('/categories', methods=['GET'])
   @cross_origin()
+  @response_cache.cached
+  @replica_router.reads
   def get_categories():
     try:
-      categoriesResult = Category.query.all()
-      categories = {}
-      for category in categoriesResult:
-        categories[category.id] = category.type
-      return jsonify({
-        'categories': categories
+      return json_response({
+        'categories': category_cache.get()
 
       })
     except:
@@ -74,26 +219,41 @@ def create_app(test_config=None):
 
   @app.route('/questions', methods=['GET'])
   @cross_origin()
+  @response_cache.cached
+  @replica_router.reads
   def get_questions():
+    page = request.args.get('page', 1, type=int)
+    currentCategory = request.args.get('currentCategory', None, type=int)
+    cursor = request.args.get('cursor', None)
+    after_id = None
+    if page < 1:
+      abort(400)
+    if cursor:
+      try:
+        after_id = decode_cursor(cursor)
+      except ValueError:
+        abort(400)
     try:
-      page = request.args.get('page', 1, type=int)
-      currentCategory = request.args.get('currentCategory', None, type=int)
-      start = (page - 1) * QUESTIONS_PER_PAGE
-      end = start + QUESTIONS_PER_PAGE
-      if currentCategory is None:
-        questions = Question.query.all()
+      snapshot = current_snapshot()
+      if snapshot is not None:
+        questions, next_cursor = snapshot.page(currentCategory, QUESTIONS_PER_PAGE, page=page, after_id=after_id)
+        totalQuestions = snapshot.count(currentCategory)
+        categories = snapshot.categories()
       else:
-        questions = Question.query.filter(Question.category == currentCategory).all()
-      categoriesResult = Category.query.all()
-      categories = {}
-      for category in categoriesResult:
-        categories[category.id] = category.type
-      formatted_questions = [q.format() for q in questions]
-      return jsonify({
-        'questions': formatted_questions[start:end],
-        'totalQuestions': len(formatted_questions),
+        if currentCategory is None:
+          selection = Question.query
+        else:
+          selection = Question.query.filter(Question.category == currentCategory)
+        questions, next_cursor = paginate_questions(question_rows(selection), QUESTIONS_PER_PAGE, page=page,
+                                                    after_id=after_id)
+        totalQuestions = question_stats.count(currentCategory)
+        categories = category_cache.get()
+      return json_response({
+        'questions': [format_row(q) for q in questions],
+        'totalQuestions': totalQuestions,
         'categories': categories,
-        'currentCategory': currentCategory
+        'currentCategory': currentCategory,
+        'nextCursor': next_cursor
 
       })
     except:
@@ -114,12 +274,14 @@ def create_app(test_config=None):
   @app.route('/questions/<int:question_id>', methods=["DELETE"])
   @cross_origin()
   def delete_question(question_id):
-    try:
+    def remove():
       questions = Question.query.filter(Question.id == question_id).one_or_none()
       if questions is None:
         abort(404)
       else:
-        questions.delete()
+        questions.delete(commit=False)
+    try:
+      write(remove)
       return jsonify({'success': True})
     except:
       abort(404)
@@ -155,13 +317,152 @@ def create_app(test_config=None):
       abort(422)
     try:
       questionObj = Question(question=question, answer=answer, difficulty=difficulty, category=category)
-      questionObj.insert()
+      write(lambda: questionObj.insert(commit=False))
       return jsonify({'success': True})
     except:
       abort(400)
 
 
 
+  '''
+  Bulk import and export of questions, for loading whole question packs.
+  '''
+
+
+
+  @app.route('/questions/import', methods=['POST'])
+  @cross_origin()
+  def bulk_import_questions():
+    format = request.args.get('format')
+    if format is None:
+      format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    if format not in FORMATS:
+      abort(422)
+    try:
+      lines = (line.decode('utf-8') for line in request.stream)
+      result = import_questions(lines, format, category_cache.get())
+    except UnicodeDecodeError:
+      abort(400)
+    result['success'] = result['errorCount'] == 0
+    return jsonify(result)
+
+
+
+  @app.route('/questions/export', methods=['GET'])
+  @cross_origin()
+  def bulk_export_questions():
+    return Response(stream_with_context(export_questions()), mimetype='application/x-ndjson')
+
+
+
+  @app.cli.command('import-questions')
+  @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+  @click.option('--format', type=click.Choice(FORMATS), default=None,
+                help='File format, guessed from the extension when omitted.')
+  def import_questions_command(path, format):
+    """Import questions from an NDJSON or CSV file."""
+    if format is None:
+      format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    with open(path, encoding='utf-8', newline='') as lines:
+      result = import_questions(lines, format, category_cache.get())
+    click.echo('{} questions imported, {} rejected'.format(result['inserted'], result['errorCount']))
+    for error in result['errors']:
+      click.echo('line {}: {}'.format(error['line'], error['error']), err=True)
+
+
+
+  @app.cli.command('export-questions')
+  @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+  def export_questions_command(path):
+    """Export every question to an NDJSON file."""
+    with open(path, 'w', encoding='utf-8') as output:
+      for line in export_questions():
+        output.write(line)
+
+
+
+  @app.cli.command('publish-snapshot')
+  def publish_snapshot_command():
+    """Export the questions and categories to a new shared snapshot."""
+    if snapshots is None:
+      raise click.ClickException('SNAPSHOT_ENABLED is off')
+    snapshots.publish()
+    click.echo('snapshot at {} is current'.format(snapshots.path))
+
+
+
+  @app.cli.command('startup-report')
+  def startup_report_command():
+    """Print how long importing and creating this app took."""
+    click.echo(json.dumps(app.startup_report, indent=2, sort_keys=True))
+
+
+
+  '''
+  Fetches known questions by id in one query, for clients that prefetch.
+  '''
+
+
+
+  @app.route('/questions/batch', methods=["POST"])
+  @cross_origin()
+  @replica_router.reads
+  def getQuestionsByIds():
+    try:
+      questionIDs = question_ids(request.get_json()['ids'], MAX_BATCH_IDS)
+    except:
+      abort(422)
+    rows = question_rows_by_id(questionIDs)
+    return json_response({
+      'success': True,
+      'questions': [format_row(rows[i]) for i in questionIDs if i in rows],
+      'missing': [i for i in questionIDs if i not in rows]
+    })
+
+
+
+  '''
+  Delta sync: the questions inserted, updated or deleted after a sync version, so offline
+  clients catch up without downloading every question again. with Accept: text/event-stream
+  the response stays open and sends the changes as they are committed.
+  '''
+
+
+
+  @app.route('/questions/changes', methods=['GET'])
+  @cross_origin()
+  def get_question_changes():
+    # a lagging replica could hand out a version whose rows it has not replayed yet, so stay on the primary
+    since = request.args.get('since', None, type=int)
+    if since is None:
+      since = request.headers.get('Last-Event-ID', 0, type=int)
+    cursor = request.args.get('cursor', None)
+    if since < 0:
+      abort(400)
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+      def stream():
+        # not stream_with_context: that would hold the request, its in-flight slot and its connection for the
+        # whole stream. the request ends when this view returns, and the polls run in an app context of their own
+        with app.app_context():
+          yield from stream_changes(since, app.config.get('SYNC_POLL_INTERVAL_MS', SYNC_POLL_INTERVAL_MS),
+                                    app.config.get('SYNC_KEEPALIVE_SECONDS', SYNC_KEEPALIVE_SECONDS),
+                                    app.config.get('SYNC_STREAM_SECONDS', SYNC_STREAM_SECONDS),
+                                    app.config['QUESTION_VERSION_FILE'])
+      return Response(stream(), mimetype='text/event-stream',
+                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    try:
+      changes, version, next_cursor = changes_since(since, cursor)
+    except ValueError:
+      abort(400)
+    return json_response({
+      'success': True,
+      'changes': changes,
+      'version': version,
+      'nextCursor': next_cursor
+    })
+
+
+
   '''
   @TODO: 
   Create a POST endpoint to get questions based on a search term. 
@@ -177,19 +478,26 @@ def create_app(test_config=None):
 
   @app.route('/questions/search', methods=["POST"])
   @cross_origin()
+  @replica_router.reads
   def searchQuestionByTerm():
     try:
       searchTerm = request.get_json()['searchTerm']
       currentCategory = request.get_json()['currentCategory']
-      search = "%{}%".format(searchTerm)
-      if currentCategory is None:
-        questions = Question.query.filter(Question.question.like(search)).all()
-      else:
-        questions = Question.query.filter(Question.category == currentCategory, Question.question.like(search)).all()
-      formatted_questions = [q.format() for q in questions]
+      page = request.get_json().get('page', None)
+      if page is not None and int(page) < 1:
+        abort(400)
+      key = (' '.join(tokenize(searchTerm)), currentCategory, page and int(page))
+      cached = search_cache.get(key)
+      if cached is None:
+        questions, totalQuestions = search.search(searchTerm, currentCategory, page=page and int(page),
+                                                  per_page=QUESTIONS_PER_PAGE)
+        cached = ([q.format() for q in questions], totalQuestions)
+        if not served_by_replica():
+          search_cache.put(key, cached)
+      formatted_questions, totalQuestions = cached
       return jsonify({
         'questions': formatted_questions,
-        'totalQuestions': len(formatted_questions),
+        'totalQuestions': totalQuestions,
         'currentCategory': currentCategory
       })
     except:
@@ -197,6 +505,32 @@ def create_app(test_config=None):
 
 
 
+  @app.route('/questions/autocomplete', methods=["GET"])
+  @cross_origin()
+  def autocomplete():
+    text = request.args.get('q', '')
+    limit = request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int)
+    if limit < 1 or limit > 50:
+      abort(400)
+    try:
+      return jsonify({
+        'suggestions': prefix_index.suggest(text, limit)
+      })
+    except:
+      abort(400)
+
+
+
+  @app.route('/stats', methods=['GET'])
+  @cross_origin()
+  @response_cache.cached
+  def get_stats():
+    summary = question_stats.summary(category_cache.get())
+    summary['success'] = True
+    return json_response(summary)
+
+
+
   '''
   @TODO: 
   Create a GET endpoint to get questions based on category. 
@@ -210,11 +544,25 @@ def create_app(test_config=None):
 
   @app.route('/categories/<int:category_id>/questions', methods=["GET"])
   @cross_origin()
+  @response_cache.cached
+  @replica_router.reads
   def getQuestionsByCategories(category_id):
     try:
-      questions = Question.query.filter(Question.category == category_id).all()
-      formatted_questions = [q.format() for q in questions]
-      return jsonify({
+      threshold = app.config.get('STREAM_THRESHOLD', STREAM_THRESHOLD)
+      batch_size = app.config.get('STREAM_BATCH_SIZE', STREAM_BATCH_SIZE)
+      snapshot = current_snapshot()
+      if snapshot is not None:
+        rows = snapshot.rows(category_id, limit=threshold + 1)
+        more = lambda after_id: snapshot.rows(category_id, after_id=after_id, limit=batch_size)
+      else:
+        selection = question_rows(Question.query.filter(Question.category == category_id)).order_by(Question.id)
+        rows = selection.limit(threshold + 1).all()
+        more = lambda after_id: selection.filter(Question.id > after_id).limit(batch_size).all()
+      if len(rows) > threshold:
+        return stream_questions({'currentCategory': category_id}, rows, keep_routing(more),
+                                lambda sent: {'totalQuestions': sent})
+      formatted_questions = [format_row(row) for row in rows]
+      return json_response({
         'questions': formatted_questions,
         'totalQuestions': len(formatted_questions),
         'currentCategory': category_id
@@ -240,27 +588,266 @@ def create_app(test_config=None):
 
   @app.route('/quizzes', methods=["POST"])
   @cross_origin()
+  @replica_router.reads
   def quiz():
     try:
       previous_questions = request.get_json()['previous_questions']
       quiz_category = request.get_json()['quiz_category']['id']
       categoryID = int(quiz_category)
-      if categoryID == 0:
-        questions = Question.query.all()
+      adaptive = bool(request.get_json().get('adaptive', False))
+      if adaptive:
+        correct_answers = int(request.get_json().get('correct_answers', 0))
+        targetDifficulty = target_difficulty(len(previous_questions), correct_answers)
+      snapshot = current_snapshot()
+      if snapshot is not None:
+        load_rows = snapshot.rows_by_id
       else:
-        questions = Question.query.filter(Question.category == categoryID).all()
+        def load_rows(ids):
+          rows = question_rows_by_id(ids)
+          missing = [questionID for questionID in ids if questionID not in rows]
+          if missing and served_by_replica():
+            # the index is built on the primary, a lagging replica may not have a new question yet
+            with on_primary():
+              rows.update(question_rows_by_id(missing))
+          return rows
+      count = request.get_json().get('count')
+      if count is not None:
+        # a whole round in one call: draw the ids in memory, then load them with one IN query
+        count = int(count)
+        if count < 1:
+          raise ValueError(count)
+        count = min(count, MAX_QUIZ_DRAW)
+        excluded = list(previous_questions)
+        drawn = []
+        remaining = 0
+        while len(drawn) < count:
+          if adaptive:
+            questionIDs, remaining = question_index.sample_adaptive(categoryID, excluded, targetDifficulty,
+                                                                    count - len(drawn))
+          else:
+            questionIDs, remaining = question_index.sample(categoryID, excluded, count - len(drawn))
+          if not questionIDs:
+            break
+          rows = load_rows(questionIDs)
+          for questionID in questionIDs:
+            if questionID in rows:
+              drawn.append(format_row(rows[questionID]))
+              remaining -= 1
+            else:
+              question_index.discard(questionID)
+          excluded.extend(questionIDs)
+        result = {
+          'questions': drawn,
+          'remainingQuestions': remaining
+        }
+        if adaptive:
+          result['targetDifficulty'] = targetDifficulty
+        return jsonify(result)
       randomQuestion = None
-      if len(questions) > 0:
-        questionsAfterFiltertion = list(filter(lambda question: question.id not in previous_questions, questions))
-        if len(questionsAfterFiltertion) > 0:
-          randomQuestion = random.choice(questionsAfterFiltertion)
-          randomQuestion = randomQuestion.format()
+      remaining = 0
+      # another worker may have deleted a question the index still holds, drop it and draw again
+      while randomQuestion is None:
+        if adaptive:
+          questionID, remaining, difficulty = question_index.pick_adaptive(categoryID, previous_questions,
+                                                                           targetDifficulty)
+        else:
+          questionID, remaining = question_index.pick(categoryID, previous_questions)
+        if questionID is None:
+          break
+        row = load_rows([questionID]).get(questionID)
+        if row is None:
+          question_index.discard(questionID)
+        else:
+          randomQuestion = format_row(row)
+      if randomQuestion is not None:
+        remaining -= 1
+
+      result = {
+        'question': randomQuestion,
+        'remainingQuestions': remaining
+      }
+      if adaptive:
+        result['targetDifficulty'] = targetDifficulty
+      return jsonify(result)
+    except:
+      abort(404)
 
-      return jsonify({
-        'question': randomQuestion
-      })
+
+
+  '''
+  Quiz sessions: the server keeps the shuffled questions of a quiz,
+  so the client only sends its session id instead of every previous question.
+  '''
+
+
+
+  @app.route('/quizzes/sessions', methods=["POST"])
+  @cross_origin()
+  def start_quiz_session():
+    try:
+      quiz_category = request.get_json()['quiz_category']['id']
+      categoryID = int(quiz_category)
     except:
+      abort(422)
+    session = QuizSession.start(categoryID, question_index.ids(categoryID))
+    quiz_sessions.put(session)
+    return jsonify({
+      'success': True,
+      'session_id': session.id,
+      'remainingQuestions': session.remaining()
+    })
+
+
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods=["POST"])
+  @cross_origin()
+  def next_quiz_question(session_id):
+    nextQuestion = None
+    # skip questions deleted since the session started
+    while nextQuestion is None:
+      try:
+        questionID, remaining = quiz_sessions.advance(session_id)
+      except KeyError:
+        abort(404)
+      if questionID is None:
+        break
+      nextQuestion = Question.query.get(questionID)
+    return jsonify({
+      'question': nextQuestion.format() if nextQuestion is not None else None,
+      'remainingQuestions': remaining
+    })
+
+
+
+  '''
+  Multiplayer quiz rooms: the host creates a room and moves it from question to question,
+  players join it, follow it over server-sent events and answer each question while it is open.
+  '''
+
+
+
+  def get_room(room_id):
+    room = rooms.get(room_id)
+    if room is None:
       abort(404)
+    return room
+
+  def room_body(*keys):
+    try:
+      body = request.get_json()
+      return [body[key] for key in keys]
+    except:
+      abort(422)
+
+  @app.route('/rooms', methods=["POST"])
+  @cross_origin()
+  def create_room():
+    quiz_category, = room_body('quiz_category')
+    try:
+      categoryID = int(quiz_category['id'])
+    except:
+      abort(422)
+    room = Room.start(categoryID, question_index.ids(categoryID))
+    rooms.put(room)
+    return jsonify({
+      'success': True,
+      'room_id': room.id,
+      'host_token': room.host_token,
+      'remainingQuestions': room.quiz.remaining()
+    })
+
+
+
+  @app.route('/rooms/<room_id>/players', methods=["POST"])
+  @cross_origin()
+  def join_room(room_id):
+    room = get_room(room_id)
+    name, = room_body('name')
+    if not isinstance(name, str) or not name.strip():
+      abort(422)
+    token, number = room.join(name.strip()[:MAX_PLAYER_NAME])
+    return jsonify({
+      'success': True,
+      'player_token': token,
+      'player': number
+    })
+
+
+
+  @app.route('/rooms/<room_id>/events', methods=["GET"])
+  @cross_origin()
+  def room_events(room_id):
+    room = get_room(room_id)
+    last_seq = request.headers.get('Last-Event-ID', None, type=int)
+    # no stream_with_context: the stream needs no database, so the request's connection goes back now
+    stream = stream_room(room, last_seq, app.config.get('ROOM_KEEPALIVE_SECONDS', ROOM_KEEPALIVE_SECONDS),
+                         app.config.get('ROOM_STREAM_SECONDS', ROOM_STREAM_SECONDS))
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+
+  @app.route('/rooms/<room_id>/answers', methods=["POST"])
+  @cross_origin()
+  def answer_room_question(room_id):
+    room = get_room(room_id)
+    token, roundNumber, answer = room_body('player_token', 'round', 'answer')
+    try:
+      accepted = room.answer(token, int(roundNumber), answer)
+    except KeyError:
+      abort(403)
+    except (TypeError, ValueError):
+      abort(422)
+    if not accepted:
+      # the host has moved on
+      abort(409)
+    return jsonify({'success': True})
+
+
+
+  @app.route('/rooms/<room_id>/next', methods=["POST"])
+  @cross_origin()
+  def next_room_question(room_id):
+    room = get_room(room_id)
+    host_token, = room_body('host_token')
+    if not room.is_host(host_token):
+      abort(403)
+    snapshot = current_snapshot()
+    room.next_round(snapshot.rows_by_id if snapshot is not None else question_rows_by_id)
+    return jsonify({
+      'success': True,
+      'round': room.round,
+      'finished': room.finished,
+      'players': room.player_count(),
+      'remainingQuestions': room.quiz.remaining()
+    })
+
+
+
+  '''
+  Health check for load balancers: pings the database and reports the connection pool.
+  '''
+
+
+
+  @app.route('/health', methods=['GET'])
+  @cross_origin()
+  def health():
+    engine = db.get_engine(app)
+    try:
+      with engine.connect() as connection:
+        connection.scalar(select([1]))
+      database = 'ok'
+    except Exception:
+      database = 'unavailable'
+    return jsonify({
+      'success': database == 'ok',
+      'database': database,
+      'pool': pool_stats(engine.pool),
+      'replicas': [pool_stats(replica.pool) for replica in replica_router.engines],
+      'groupCommit': group_commit.stats() if group_commit is not None else None,
+      'rooms': rooms.stats()
+    }), 200 if database == 'ok' else 503
 
 
 
@@ -280,6 +867,14 @@ def create_app(test_config=None):
       "message": "Bad Request"
     }), 400
 
+  @app.errorhandler(403)
+  def forbidden(error):
+    return jsonify({
+      "success": False,
+      "error": 403,
+      "message": "Forbidden"
+    }), 403
+
   @app.errorhandler(404)
   def not_found(error):
     return jsonify({
@@ -306,6 +901,15 @@ def create_app(test_config=None):
     }), 408
 
 
+  @app.errorhandler(409)
+  def conflict(error):
+    return jsonify({
+      "success": False,
+      "error": 409,
+      "message": "Conflict"
+    }), 409
+
+
   @app.errorhandler(422)
   def unprocessable_entity(error):
     return jsonify({
@@ -341,6 +945,28 @@ def create_app(test_config=None):
     }), 500
 
 
+  @app.errorhandler(503)
+  def service_unavailable(error):
+    return jsonify({
+      "success": False,
+      "error": 503,
+      "message": "Service Unavailable"
+    }), 503
+
+  startup.mark('routes')
+  if app.config.get('PRELOAD_CACHES', PRELOAD_CACHES):
+    startup.note('preloaded', preload_caches(app, (('categories', category_cache), ('questionIds', question_index),
+                                                   ('stats', question_stats), ('search', search),
+                                                   ('autocomplete', prefix_index))))
+    startup.mark('preload')
+  if snapshots is not None:
+    # maps the snapshot, or exports the first one
+    with app.app_context():
+      snapshots.current()
+    startup.mark('snapshot')
+  app.startup_report = startup.as_dict()
+  app.logger.info(startup.summary())
+
   return app
 
     
\ No newline at end of file
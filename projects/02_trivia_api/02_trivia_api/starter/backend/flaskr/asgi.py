@@ -0,0 +1,543 @@
+import asyncio
+import os
+import random
+import time
+from databases import Database
+from sqlalchemy import and_, func, select
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from models import database_path, Question, Category, QuestionTombstone, SyncVersion
+from .changes import VersionFile
+from .pagination import encode_cursor, decode_cursor
+from .category_cache import CATEGORY_CACHE_TTL, CATEGORY_VERSION_FILE
+from .quiz import QUESTION_VERSION_FILE, ALL_CATEGORIES, MAX_QUIZ_DRAW, DIFFICULTIES, target_difficulty
+from .pool import DB_CONNECT_TIMEOUT, DB_STATEMENT_TIMEOUT
+from .quiz_sessions import QuizSession, create_session_store
+from .search import SearchData, PostgresSearch, SEARCH_INDEX_TTL, create_search
+from .autocomplete import PrefixData, AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_TTL
+from .serialization import question_ids
+from .stats import STATS_TTL, tally, summarize
+
+QUESTIONS_PER_PAGE = 10
+MAX_BATCH_IDS = 100
+ASYNC_POOL_MIN_SIZE = 1
+ASYNC_POOL_MAX_SIZE = 20
+
+questions = Question.__table__
+categories = Category.__table__
+tombstones = QuestionTombstone.__table__
+sync_versions = SyncVersion.__table__
+
+MESSAGES = {
+  400: 'Bad Request',
+  404: 'Not Found',
+  405: 'Method Not Allowed',
+  408: 'Request Timeout',
+  422: 'Unprocessable Entity',
+  429: 'Too Many Requests',
+  431: 'Request Header Fields Too Large',
+  500: 'Internal Server Error'
+}
+
+
+'''
+async_database_url(url)
+    the same database as a SQLAlchemy URL, in the form the databases package expects
+'''
+def async_database_url(url):
+  scheme, rest = url.split('://', 1)
+  return scheme.split('+', 1)[0] + '://' + rest
+
+
+'''
+adaptive_order(rows, difficulty)
+    the ids of the (id, difficulty) rows in the order an adaptive quiz draws them, as
+    QuestionIdIndex.pick_adaptive() does: shuffled at the given difficulty, then at the nearest
+    ones (the easier first on a tie), and questions without a known difficulty last
+'''
+def adaptive_order(rows, difficulty):
+  buckets = {}
+  for row in rows:
+    buckets.setdefault(row['difficulty'] if row['difficulty'] in DIFFICULTIES else None, []).append(row['id'])
+  ordered = []
+  for nearest in sorted(DIFFICULTIES, key=lambda d: (abs(d - difficulty), d)) + [None]:
+    bucket = buckets.get(nearest, [])
+    random.shuffle(bucket)
+    ordered.extend(bucket)
+  return ordered
+
+
+def format_question(row):
+  return {
+    'id': row['id'],
+    'question': row['question'],
+    'answer': row['answer'],
+    'category': row['category'],
+    'difficulty': row['difficulty']
+  }
+
+
+'''
+AsyncVersionedData
+    the async app's counterpart of VersionedIndex: a value loaded with an async query, kept until
+    the shared version file moves on (every write from either app on this host bumps it) or for
+    ttl seconds, for writes from other hosts. concurrent requests wait for one load
+'''
+class AsyncVersionedData(object):
+
+  def __init__(self, load, version_file, ttl):
+    self.load = load
+    self.version_file = VersionFile(version_file)
+    self.ttl = ttl
+    self._data = None
+    self._version = None
+    self._loaded_at = 0
+    # an asyncio lock belongs to one event loop, it is made in the loop serving the requests
+    self._lock = None
+    self._lock_loop = None
+
+  def _fresh(self, version):
+    return self._data is not None and version == self._version and time.time() - self._loaded_at < self.ttl
+
+  async def data(self):
+    version = self.version_file.value()
+    if self._fresh(version):
+      return self._data
+    loop = asyncio.get_running_loop()
+    if self._lock_loop is not loop:
+      self._lock, self._lock_loop = asyncio.Lock(), loop
+    async with self._lock:
+      if not self._fresh(version):
+        self._data = await self.load()
+        self._version = version
+        self._loaded_at = time.time()
+      return self._data
+
+
+'''
+create_asgi_app(test_config)
+    the trivia API as an ASGI app on an async connection pool, with the same routes and
+    JSON as create_app(). blocking in a Flask worker ties up a thread per in-flight request,
+    here a worker multiplexes many slow queries on one event loop. run it with
+        uvicorn asgi:app
+    bulk import/export, the CLI commands and /metrics stay on the Flask app.
+'''
+def create_asgi_app(test_config=None):
+  config = {
+    'SQLALCHEMY_DATABASE_URI': os.getenv('SQLALCHEMY_DATABASE_URI', database_path),
+    'ASYNC_POOL_MIN_SIZE': int(os.getenv('ASYNC_POOL_MIN_SIZE', ASYNC_POOL_MIN_SIZE)),
+    'ASYNC_POOL_MAX_SIZE': int(os.getenv('ASYNC_POOL_MAX_SIZE', ASYNC_POOL_MAX_SIZE)),
+    'QUESTION_VERSION_FILE': os.getenv('QUESTION_VERSION_FILE', QUESTION_VERSION_FILE),
+    'CATEGORY_VERSION_FILE': os.getenv('CATEGORY_VERSION_FILE', CATEGORY_VERSION_FILE)
+  }
+  for key in ('QUIZ_SESSION_STORE', 'QUIZ_SESSION_DB', 'SEARCH_BACKEND'):
+    if os.getenv(key):
+      config[key] = os.getenv(key)
+  for key in ('QUIZ_SESSION_MAX', 'QUIZ_SESSION_TTL', 'DB_CONNECT_TIMEOUT', 'DB_STATEMENT_TIMEOUT', 'CATEGORY_CACHE_TTL',
+              'SEARCH_INDEX_TTL'):
+    if os.getenv(key):
+      config[key] = int(os.getenv(key))
+  if test_config is not None:
+    config.update(test_config)
+  url = async_database_url(config['SQLALCHEMY_DATABASE_URI'])
+  if url.startswith('sqlite'):
+    database = Database(url)
+  else:
+    options = {'timeout': config.get('DB_CONNECT_TIMEOUT', DB_CONNECT_TIMEOUT)}
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT', DB_STATEMENT_TIMEOUT)
+    if statement_timeout:
+      options['server_settings'] = {'statement_timeout': str(statement_timeout)}
+    database = Database(url, min_size=config['ASYNC_POOL_MIN_SIZE'], max_size=config['ASYNC_POOL_MAX_SIZE'], **options)
+  question_version = VersionFile(config['QUESTION_VERSION_FILE'])
+  search = create_search(config)
+  quiz_sessions = create_session_store(config)
+
+  async def load_categories():
+    rows = await database.fetch_all(select([categories.c.id, categories.c.type]))
+    return dict((row['id'], row['type']) for row in rows)
+  category_cache = AsyncVersionedData(load_categories, config['CATEGORY_VERSION_FILE'],
+                                      config.get('CATEGORY_CACHE_TTL', CATEGORY_CACHE_TTL))
+
+  async def load_search_data():
+    data = SearchData()
+    rows = await database.fetch_all(select([questions.c.id, questions.c.question, questions.c.category]))
+    for row in rows:
+      data.add(row['id'], row['question'], row['category'])
+    return data
+  search_data = AsyncVersionedData(load_search_data, config['QUESTION_VERSION_FILE'],
+                                   config.get('SEARCH_INDEX_TTL', SEARCH_INDEX_TTL))
+
+  async def load_prefix_data():
+    data = PrefixData()
+    for row in await database.fetch_all(select([questions.c.id, questions.c.question])):
+      data.add(row['id'], row['question'])
+    return data
+  prefix_data = AsyncVersionedData(load_prefix_data, config['QUESTION_VERSION_FILE'], AUTOCOMPLETE_TTL)
+
+  async def load_stats():
+    rows = await database.fetch_all(
+      select([questions.c.category, questions.c.difficulty, func.count(questions.c.id)])
+      .group_by(questions.c.category, questions.c.difficulty))
+    return tally((row[0], row[1], row[2]) for row in rows)
+  question_stats = AsyncVersionedData(load_stats, config['QUESTION_VERSION_FILE'], config.get('STATS_TTL', STATS_TTL))
+
+  async def json_body(request):
+    try:
+      body = await request.json()
+    except ValueError:
+      raise HTTPException(400)
+    if not isinstance(body, dict):
+      raise HTTPException(400)
+    return body
+
+
+  async def fetch_questions(ids):
+    if not ids:
+      return {}
+    rows = await database.fetch_all(select([questions]).where(questions.c.id.in_(ids)))
+    return dict((row['id'], row) for row in rows)
+
+
+  async def get_categories(request):
+    return JSONResponse({
+      'categories': await category_cache.data()
+    })
+
+
+  async def get_stats(request):
+    summary = summarize((await question_stats.data()).items(), await category_cache.data())
+    summary['success'] = True
+    return JSONResponse(summary)
+
+
+  async def get_questions(request):
+    try:
+      page = int(request.query_params.get('page', 1))
+    except ValueError:
+      page = 1
+    try:
+      currentCategory = int(request.query_params['currentCategory'])
+    except (KeyError, ValueError):
+      currentCategory = None
+    cursor = request.query_params.get('cursor')
+    after_id = None
+    if page < 1:
+      raise HTTPException(400)
+    if cursor:
+      try:
+        after_id = decode_cursor(cursor)
+      except ValueError:
+        raise HTTPException(400)
+    try:
+      condition = questions.c.category == currentCategory if currentCategory is not None else None
+      selection = select([questions])
+      counting = select([func.count(questions.c.id)])
+      if condition is not None:
+        selection = selection.where(condition)
+        counting = counting.where(condition)
+      selection = selection.order_by(questions.c.id).limit(QUESTIONS_PER_PAGE + 1)
+      if after_id is not None:
+        selection = selection.where(questions.c.id > after_id)
+      else:
+        selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
+      rows = await database.fetch_all(selection)
+      next_cursor = None
+      if len(rows) > QUESTIONS_PER_PAGE:
+        rows = rows[:QUESTIONS_PER_PAGE]
+        next_cursor = encode_cursor(rows[-1]['id'])
+      return JSONResponse({
+        'questions': [format_question(row) for row in rows],
+        'totalQuestions': await database.fetch_val(counting),
+        'categories': await category_cache.data(),
+        'currentCategory': currentCategory,
+        'nextCursor': next_cursor
+      })
+    except HTTPException:
+      raise
+    except Exception:
+      raise HTTPException(404)
+
+
+  async def next_sync_version():
+    # models.sync_version() for the ORM, called inside the transaction of the write it numbers
+    await database.execute(sync_versions.update().where(sync_versions.c.id == 1)
+                           .values(version=sync_versions.c.version + 1))
+    version = await database.fetch_val(select([sync_versions.c.version]).where(sync_versions.c.id == 1))
+    if version is None:
+      await database.execute(sync_versions.insert(), {'id': 1, 'version': 1})
+      version = 1
+    return version
+
+
+  async def delete_question(request):
+    question_id = request.path_params['question_id']
+    async with database.transaction():
+      deleted = await database.fetch_val(select([questions.c.id]).where(questions.c.id == question_id))
+      if deleted is None:
+        raise HTTPException(404)
+      await database.execute(questions.delete().where(questions.c.id == question_id))
+      version = await next_sync_version()
+      await database.execute(tombstones.delete().where(tombstones.c.question_id == question_id))
+      await database.execute(tombstones.insert(), {'question_id': question_id, 'version': version})
+    question_version.bump()
+    return JSONResponse({'success': True})
+
+
+  async def create_question(request):
+    try:
+      body = await request.json()
+      values = {
+        'question': body['question'],
+        'answer': body['answer'],
+        'difficulty': body['difficulty'],
+        'category': body['category']
+      }
+    except Exception:
+      raise HTTPException(422)
+    try:
+      # asyncpg binds parameters by their Postgres type, psycopg2 let the server cast strings
+      values['difficulty'] = int(values['difficulty'])
+      values['category'] = int(values['category'])
+      async with database.transaction():
+        values['version'] = await next_sync_version()
+        await database.execute(questions.insert(), values)
+    except Exception:
+      raise HTTPException(400)
+    question_version.bump()
+    return JSONResponse({'success': True})
+
+
+  async def get_questions_by_ids(request):
+    body = await json_body(request)
+    try:
+      questionIDs = question_ids(body['ids'], MAX_BATCH_IDS)
+    except Exception:
+      raise HTTPException(422)
+    rows = await fetch_questions(questionIDs)
+    return JSONResponse({
+      'success': True,
+      'questions': [format_question(rows[i]) for i in questionIDs if i in rows],
+      'missing': [i for i in questionIDs if i not in rows]
+    })
+
+
+  async def search_questions(request):
+    try:
+      body = await json_body(request)
+      searchTerm = body['searchTerm']
+      currentCategory = body['currentCategory']
+      page = body.get('page', None)
+      if page is not None:
+        page = int(page)
+        if page < 1:
+          raise ValueError('page must be positive')
+      if isinstance(search, PostgresSearch):
+        selection = select([questions])
+        counting = select([func.count(questions.c.id)])
+        conditions = []
+        if currentCategory is not None:
+          conditions.append(questions.c.category == currentCategory)
+        match = search.match(searchTerm)
+        if match is not None:
+          conditions.append(match[0])
+          selection = selection.order_by(match[1].desc(), questions.c.id)
+        else:
+          selection = selection.order_by(questions.c.id)
+        if conditions:
+          selection = selection.where(and_(*conditions))
+          counting = counting.where(and_(*conditions))
+        if page is not None:
+          selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE)
+        rows = await database.fetch_all(selection)
+        totalQuestions = await database.fetch_val(counting)
+      else:
+        ranked = (await search_data.data()).rank(searchTerm, currentCategory)
+        ids = ranked if page is None else ranked[(page - 1) * QUESTIONS_PER_PAGE:page * QUESTIONS_PER_PAGE]
+        found = {}
+        if ids:
+          for row in await database.fetch_all(select([questions]).where(questions.c.id.in_(ids))):
+            found[row['id']] = row
+        rows = [found[i] for i in ids if i in found]
+        totalQuestions = len(ranked)
+      return JSONResponse({
+        'questions': [format_question(row) for row in rows],
+        'totalQuestions': totalQuestions,
+        'currentCategory': currentCategory
+      })
+    except Exception:
+      raise HTTPException(400)
+
+
+  async def autocomplete(request):
+    text = request.query_params.get('q', '')
+    try:
+      limit = int(request.query_params.get('limit', AUTOCOMPLETE_LIMIT))
+    except ValueError:
+      limit = AUTOCOMPLETE_LIMIT
+    if limit < 1 or limit > 50:
+      raise HTTPException(400)
+    try:
+      return JSONResponse({
+        'suggestions': (await prefix_data.data()).suggest(text, limit)
+      })
+    except Exception:
+      raise HTTPException(400)
+
+
+  async def get_questions_by_category(request):
+    category_id = request.path_params['category_id']
+    try:
+      rows = await database.fetch_all(
+        select([questions]).where(questions.c.category == category_id).order_by(questions.c.id))
+      formatted_questions = [format_question(row) for row in rows]
+      return JSONResponse({
+        'questions': formatted_questions,
+        'totalQuestions': len(formatted_questions),
+        'currentCategory': category_id
+      })
+    except Exception:
+      raise HTTPException(404)
+
+
+  async def quiz(request):
+    try:
+      body = await json_body(request)
+      previous_questions = [int(i) for i in body['previous_questions']]
+      categoryID = int(body['quiz_category']['id'])
+      adaptive = bool(body.get('adaptive', False))
+      if adaptive:
+        targetDifficulty = target_difficulty(len(previous_questions), int(body.get('correct_answers', 0)))
+      conditions = []
+      if categoryID != ALL_CATEGORIES:
+        conditions.append(questions.c.category == categoryID)
+      if previous_questions:
+        conditions.append(questions.c.id.notin_(previous_questions))
+      count = body.get('count')
+      if count is not None or adaptive:
+        # an adaptive draw looks at the difficulty of every unseen question, a single one included
+        draw = 1 if count is None else int(count)
+        if draw < 1:
+          raise ValueError(count)
+        unseen = select([questions.c.id, questions.c.difficulty])
+        if conditions:
+          unseen = unseen.where(and_(*conditions))
+        unseenRows = await database.fetch_all(unseen)
+        if adaptive:
+          picked = adaptive_order(unseenRows, targetDifficulty)[:min(draw, MAX_QUIZ_DRAW)]
+        else:
+          picked = random.sample([row['id'] for row in unseenRows], min(draw, MAX_QUIZ_DRAW, len(unseenRows)))
+        rows = await fetch_questions(picked)
+        drawn = [format_question(rows[i]) for i in picked if i in rows]
+        result = {'remainingQuestions': len(unseenRows) - len(drawn)}
+        if count is not None:
+          result['questions'] = drawn
+        else:
+          result['question'] = drawn[0] if drawn else None
+        if adaptive:
+          result['targetDifficulty'] = targetDifficulty
+        return JSONResponse(result)
+      counting = select([func.count(questions.c.id)])
+      selection = select([questions]).order_by(questions.c.id)
+      if conditions:
+        counting = counting.where(and_(*conditions))
+        selection = selection.where(and_(*conditions))
+      remaining = await database.fetch_val(counting)
+      randomQuestion = None
+      if remaining:
+        row = await database.fetch_one(selection.offset(random.randrange(remaining)).limit(1))
+        if row is not None:
+          randomQuestion = format_question(row)
+          remaining -= 1
+        else:
+          remaining = 0
+      return JSONResponse({
+        'question': randomQuestion,
+        'remainingQuestions': remaining
+      })
+    except Exception:
+      raise HTTPException(404)
+
+
+  async def start_quiz_session(request):
+    try:
+      body = await request.json()
+      categoryID = int(body['quiz_category']['id'])
+    except Exception:
+      raise HTTPException(422)
+    selection = select([questions.c.id])
+    if categoryID != ALL_CATEGORIES:
+      selection = selection.where(questions.c.category == categoryID)
+    session = QuizSession.start(categoryID, [row['id'] for row in await database.fetch_all(selection)])
+    quiz_sessions.put(session)
+    return JSONResponse({
+      'success': True,
+      'session_id': session.id,
+      'remainingQuestions': session.remaining()
+    })
+
+
+  async def next_quiz_question(request):
+    nextQuestion = None
+    # skip questions deleted since the session started
+    while nextQuestion is None:
+      try:
+        questionID, remaining = quiz_sessions.advance(request.path_params['session_id'])
+      except KeyError:
+        raise HTTPException(404)
+      if questionID is None:
+        break
+      nextQuestion = await database.fetch_one(select([questions]).where(questions.c.id == questionID))
+    return JSONResponse({
+      'question': format_question(nextQuestion) if nextQuestion is not None else None,
+      'remainingQuestions': remaining
+    })
+
+
+  async def http_error(request, error):
+    code = error.status_code if error.status_code in MESSAGES else 500
+    return JSONResponse({
+      "success": False,
+      "error": code,
+      "message": MESSAGES[code]
+    }, status_code=code)
+
+  async def internal_server_error(request, error):
+    return JSONResponse({
+      "success": False,
+      "error": 500,
+      "message": MESSAGES[500]
+    }, status_code=500)
+
+
+  app = Starlette(
+    routes=[
+      Route('/categories', get_categories, methods=['GET']),
+      Route('/stats', get_stats, methods=['GET']),
+      Route('/questions', get_questions, methods=['GET']),
+      Route('/questions', create_question, methods=['POST']),
+      Route('/questions/{question_id:int}', delete_question, methods=['DELETE']),
+      Route('/questions/batch', get_questions_by_ids, methods=['POST']),
+      Route('/questions/search', search_questions, methods=['POST']),
+      Route('/questions/autocomplete', autocomplete, methods=['GET']),
+      Route('/categories/{category_id:int}/questions', get_questions_by_category, methods=['GET']),
+      Route('/quizzes', quiz, methods=['POST']),
+      Route('/quizzes/sessions', start_quiz_session, methods=['POST']),
+      Route('/quizzes/sessions/{session_id}/next', next_quiz_question, methods=['POST'])
+    ],
+    middleware=[
+      Middleware(CORSMiddleware, allow_origins=['*'],
+                 allow_headers=['Content-Type', 'Authorization'],
+                 allow_methods=['GET', 'POST', 'PATCH', 'DELETE', 'OPTIONS'])
+    ],
+    exception_handlers={HTTPException: http_error, Exception: internal_server_error},
+    on_startup=[database.connect],
+    on_shutdown=[database.disconnect]
+  )
+  app.state.database = database
+  return app
+
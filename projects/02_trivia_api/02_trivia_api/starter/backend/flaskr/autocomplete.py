@@ -0,0 +1,89 @@
+import heapq
+from bisect import bisect_left, insort
+
+from models import db, Question
+from .changes import VersionedIndex
+from .quiz import QUESTION_VERSION_FILE
+from .search import tokenize
+
+AUTOCOMPLETE_TTL = 300
+AUTOCOMPLETE_LIMIT = 10
+
+
+'''
+PrefixData
+    a sorted array of the words used in questions and how many questions use each one,
+    so every word starting with a prefix sits in one contiguous slice found by bisect.
+'''
+class PrefixData(object):
+
+  def __init__(self):
+    self.tokens = []
+    self.counts = {}
+    self.documents = {}
+
+  def add(self, question_id, question):
+    self.remove(question_id)
+    tokens = frozenset(tokenize(question))
+    self.documents[question_id] = tokens
+    for token in tokens:
+      if token not in self.counts:
+        self.counts[token] = 0
+        insort(self.tokens, token)
+      self.counts[token] += 1
+
+  def remove(self, question_id):
+    for token in self.documents.pop(question_id, ()):
+      self.counts[token] -= 1
+      if not self.counts[token]:
+        del self.counts[token]
+        del self.tokens[bisect_left(self.tokens, token)]
+
+  def complete(self, prefix, limit):
+    '''returns up to limit words starting with prefix, most used first'''
+    start = bisect_left(self.tokens, prefix)
+    end = bisect_left(self.tokens, prefix + u'\U0010ffff', start)
+    counts = self.counts
+    return heapq.nsmallest(limit, self.tokens[start:end], key=lambda token: (-counts[token], token))
+
+  def suggest(self, text, limit=AUTOCOMPLETE_LIMIT):
+    '''completes the last word of text, keeping the words before it'''
+    tokens = tokenize(text)
+    if not tokens or not text[-1:].isalnum():
+      return []
+    words = self.complete(tokens[-1], limit)
+    head = ' '.join(tokens[:-1])
+    return [head + ' ' + word if head else word for word in words]
+
+
+'''
+PrefixIndex
+    answers autocomplete queries from memory, without touching the database
+'''
+class PrefixIndex(VersionedIndex):
+
+  model = Question
+
+  def __init__(self, ttl=AUTOCOMPLETE_TTL, version_file=QUESTION_VERSION_FILE):
+    super(PrefixIndex, self).__init__(ttl, version_file)
+
+  def load(self):
+    data = PrefixData()
+    for question_id, question in db.session.query(Question.id, Question.question):
+      data.add(question_id, question)
+    return data
+
+  def apply(self, data, changes):
+    for operation, row in changes:
+      if operation == 'delete':
+        data.remove(row['id'])
+      else:
+        data.add(row['id'], row['question'])
+    return True
+
+  def suggest(self, text, limit=AUTOCOMPLETE_LIMIT):
+    '''completes the last word of text, keeping the words before it'''
+    data = self.data()
+    with self._lock:
+      return data.suggest(text, limit)
+
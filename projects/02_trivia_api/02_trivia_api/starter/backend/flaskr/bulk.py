@@ -0,0 +1,129 @@
+import csv
+import json
+
+from models import db, Question
+from .changes import invalidate_model
+from .serialization import QUESTION_COLUMNS, format_row
+
+IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+FORMATS = ('ndjson', 'csv')
+
+
+'''
+read_rows(lines, format)
+    yields (line number, row dict) for every non-empty NDJSON line or CSV record,
+    or (line number, error message) when the line cannot be parsed
+'''
+def read_rows(lines, format):
+  if format == 'csv':
+    reader = csv.DictReader(lines)
+    for row in reader:
+      yield reader.line_num, row
+    return
+  for number, line in enumerate(lines, 1):
+    if not line.strip():
+      continue
+    try:
+      row = json.loads(line)
+    except ValueError:
+      yield number, 'invalid JSON'
+      continue
+    if not isinstance(row, dict):
+      yield number, 'expected a JSON object'
+      continue
+    yield number, row
+
+
+'''
+validate_row(row, categories)
+    returns the values to insert for a row, raises ValueError with the reason it was rejected
+'''
+def validate_row(row, categories):
+  values = {}
+  for column in ('question', 'answer'):
+    value = row.get(column)
+    if not isinstance(value, str) or not value.strip():
+      raise ValueError('{} is required'.format(column))
+    values[column] = value.strip()
+  for column in ('category', 'difficulty'):
+    try:
+      values[column] = int(row.get(column))
+    except (TypeError, ValueError):
+      raise ValueError('{} must be an integer'.format(column))
+  if values['category'] not in categories:
+    raise ValueError('unknown category {}'.format(values['category']))
+  if not 1 <= values['difficulty'] <= 5:
+    raise ValueError('difficulty must be between 1 and 5')
+  return values
+
+
+'''
+import_questions(lines, format, categories, batch_size)
+    validates the rows and inserts the valid ones with one executemany per batch,
+    each batch in its own transaction. when a batch fails its rows are retried one by one,
+    so a bad row only rejects itself. returns the number inserted and the rejected rows.
+'''
+def import_questions(lines, format, categories, batch_size=IMPORT_BATCH_SIZE):
+  result = {'inserted': 0, 'errorCount': 0, 'errors': []}
+
+  def reject(number, message):
+    result['errorCount'] += 1
+    if len(result['errors']) < MAX_REPORTED_ERRORS:
+      result['errors'].append({'line': number, 'error': message})
+
+  def flush(batch):
+    try:
+      db.session.execute(Question.__table__.insert(), [values for number, values in batch])
+      db.session.commit()
+      result['inserted'] += len(batch)
+    except Exception:
+      db.session.rollback()
+      for number, values in batch:
+        try:
+          db.session.execute(Question.__table__.insert(), [values])
+          db.session.commit()
+          result['inserted'] += 1
+        except Exception as error:
+          db.session.rollback()
+          reject(number, str(getattr(error, 'orig', error)).strip())
+
+  batch = []
+  try:
+    for number, row in read_rows(lines, format):
+      if not isinstance(row, dict):
+        reject(number, row)
+        continue
+      try:
+        batch.append((number, validate_row(row, categories)))
+      except ValueError as error:
+        reject(number, str(error))
+        continue
+      if len(batch) >= batch_size:
+        flush(batch)
+        batch = []
+    if batch:
+      flush(batch)
+  finally:
+    # the inserts bypassed the ORM, so the commit hooks did not see them
+    if result['inserted']:
+      invalidate_model(Question)
+  return result
+
+
+'''
+export_questions(batch_size)
+    yields the questions table as NDJSON lines in id order.
+    rows are read in keyset batches of plain tuples, so memory stays constant however big the table is.
+'''
+def export_questions(batch_size=EXPORT_BATCH_SIZE):
+  after_id = 0
+  while True:
+    rows = db.session.query(*QUESTION_COLUMNS).filter(Question.id > after_id).order_by(Question.id).limit(batch_size).all()
+    if not rows:
+      return
+    for row in rows:
+      yield json.dumps(format_row(row)) + '\n'
+    after_id = rows[-1][0]
@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+from models import Category
+from .changes import VersionedIndex
+
+CATEGORY_CACHE_TTL = 300
+CATEGORY_VERSION_FILE = os.path.join(tempfile.gettempdir(), 'trivia_categories.version')
+
+
+'''
+CategoryCache
+    keeps the {id: type} dict of categories in process memory.
+    an entry is reloaded when it is older than ttl seconds or when the shared version file changed,
+    so a category write in one worker is seen by the others without a DB round-trip per request.
+'''
+class CategoryCache(VersionedIndex):
+
+  model = Category
+
+  def __init__(self, ttl=CATEGORY_CACHE_TTL, version_file=CATEGORY_VERSION_FILE):
+    super(CategoryCache, self).__init__(ttl, version_file)
+
+  def load(self):
+    categories = {}
+    for category in Category.query.order_by(Category.id).all():
+      categories[category.id] = category.type
+    return categories
+
+  def get(self):
+    '''returns the cached {id: type} dict, it must be treated as read-only'''
+    return self.data()
@@ -0,0 +1,223 @@
+import os
+import tempfile
+import threading
+import time
+import weakref
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from .replicas import on_primary
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# model class -> callbacks registered with on_commit
+_listeners = {}
+
+# model class -> live VersionedIndex instances built from it
+_indexes = {}
+
+# model class -> callbacks registered with on_version_bump
+_bump_listeners = {}
+
+
+'''
+VersionFile
+    a version counter shared by every worker on the host, kept as a fixed-width decimal number so
+    the file never grows. a bump increments it under an exclusive lock on a side file and renames
+    the new value into place, so a reader always sees a whole number and reading it is one small
+    read. a file of the earlier format, one byte appended per bump, counts on from its size.
+'''
+class VersionFile(object):
+
+  WIDTH = 20
+  _threads = threading.Lock()
+
+  def __init__(self, path):
+    self.path = path
+
+  def value(self):
+    try:
+      with open(self.path, 'rb') as f:
+        data = f.read(self.WIDTH)
+        if data.isdigit():
+          return int(data)
+        return os.fstat(f.fileno()).st_size
+    except OSError:
+      return 0
+
+  def bump(self):
+    with self._threads, open(self.path + '.lock', 'a') as lock:
+      if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        version = self.value() + 1
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path) + '.')
+        try:
+          with os.fdopen(descriptor, 'wb') as f:
+            f.write(str(version).zfill(self.WIDTH).encode('ascii'))
+          os.replace(temporary, self.path)
+        except BaseException:
+          os.unlink(temporary)
+          raise
+      finally:
+        if fcntl is not None:
+          fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+'''
+on_commit(model, callback)
+    calls callback(changes) after every commit that inserted, updated or deleted rows of model.
+    changes is a list of (operation, row) tuples in flush order, operation is 'insert', 'update'
+    or 'delete' and row is a dict of the column values captured at flush time.
+'''
+def on_commit(model, callback):
+  if model not in _listeners:
+    _listeners[model] = []
+    for operation in ('insert', 'update', 'delete'):
+      event.listen(model, 'after_' + operation, _recorder(model, operation))
+  _listeners[model].append(callback)
+
+
+def _recorder(model, operation):
+  def record(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+      return
+    row = {}
+    for attribute in mapper.column_attrs:
+      row[attribute.key] = getattr(target, attribute.key)
+    session.info.setdefault('pending_changes', {}).setdefault(model, []).append((operation, row))
+  return record
+
+
+'''
+on_version_bump(model, callback)
+    calls callback() after this worker bumped the version files of model's indexes, once the
+    new version is visible to every worker, for work that is keyed on the version (snapshots)
+'''
+def on_version_bump(model, callback):
+  _bump_listeners.setdefault(model, []).append(callback)
+
+
+def _bumped(model):
+  for callback in _bump_listeners.get(model, []):
+    callback()
+
+
+@event.listens_for(Session, 'after_commit')
+def _dispatch_after_commit(session):
+  pending = session.info.pop('pending_changes', None)
+  if not pending:
+    return
+  for model, changes in pending.items():
+    for callback in _listeners.get(model, []):
+      callback(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+  session.info.pop('pending_changes', None)
+
+
+'''
+VersionedIndex
+    base class for in-process structures built from one model's table.
+    the structure is built by load() on first use, kept current by apply() after commits in this
+    worker, and rebuilt after ttl seconds or when another worker bumps the shared version file.
+    subclasses set model and implement load(), apply() defaults to a rebuild on next use.
+'''
+class VersionedIndex(object):
+
+  model = None
+
+  def __init__(self, ttl, version_file):
+    self.ttl = ttl
+    self.version_file = VersionFile(version_file)
+    self._lock = threading.RLock()
+    self._data = None
+    self._version = None
+    self._loaded_at = 0
+    if self.model not in _indexes:
+      _indexes[self.model] = weakref.WeakSet()
+      on_commit(self.model, _commit_callback(self.model))
+    _indexes[self.model].add(self)
+
+  def _fresh(self, version):
+    return self._data is not None and version == self._version and time.time() - self._loaded_at < self.ttl
+
+  def data(self):
+    version = self.version_file.value()
+    data = self._data
+    if data is not None and self._fresh(version):
+      return data
+    with self._lock:
+      if not self._fresh(version):
+        # a lagging replica would leave the index stale until the next version bump
+        with on_primary():
+          self._data = self.load()
+        self._version = version
+        self._loaded_at = time.time()
+      return self._data
+
+  def load(self):
+    raise NotImplementedError
+
+  def apply(self, data, changes):
+    '''updates data in place for changes committed by this worker, returns False to rebuild instead'''
+    return False
+
+  def clear(self):
+    with self._lock:
+      self._data = None
+
+  def invalidate(self):
+    '''drops the local copy and bumps the shared version so other workers rebuild too'''
+    self.clear()
+    self.version_file.bump()
+
+  def _after_commit(self, changes):
+    with self._lock:
+      if self._data is None:
+        return
+      # one read for both, a write landing between two reads would be taken for ours
+      version = self.version_file.value()
+      # another worker wrote since our copy was loaded, applying ours would hide its changes
+      if self._version != version:
+        self._data = None
+        return
+      if self.apply(self._data, changes):
+        # our own writes are applied, so follow the bump that is about to be made
+        self._version = version + 1
+      else:
+        self._data = None
+
+
+'''
+invalidate_model(model)
+    for writes that bypass the ORM, such as bulk inserts: drops every index built from model
+    in this worker and bumps their version files so the other workers rebuild too
+'''
+def invalidate_model(model):
+  paths = set()
+  for index in list(_indexes.get(model, ())):
+    index.clear()
+    paths.add(index.version_file.path)
+  for path in paths:
+    VersionFile(path).bump()
+  _bumped(model)
+
+
+def _commit_callback(model):
+  def callback(changes):
+    paths = set()
+    for index in list(_indexes[model]):
+      index._after_commit(changes)
+      paths.add(index.version_file.path)
+    for path in paths:
+      VersionFile(path).bump()
+    _bumped(model)
+  return callback
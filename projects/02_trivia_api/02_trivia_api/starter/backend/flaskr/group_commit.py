@@ -0,0 +1,111 @@
+import threading
+from werkzeug.exceptions import HTTPException
+
+from models import db
+from .replicas import mark_written
+
+GROUP_COMMIT_ENABLED = False
+# how long the first write of a batch waits for others to join it
+GROUP_COMMIT_DELAY_MS = 5
+# a batch is committed as soon as it has this many writes
+GROUP_COMMIT_MAX_BATCH = 64
+
+
+class _Entry(object):
+
+  def __init__(self, operation):
+    self.operation = operation
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class _Batch(object):
+
+  def __init__(self):
+    self.entries = []
+    self.full = threading.Event()
+
+
+'''
+GroupCommitter
+    coalesces the writes of concurrent requests into one transaction. submit(operation) queues a
+    function that changes db.session without committing; the first request of a batch leads it:
+    it waits up to delay_ms for others (or until max_batch are queued), runs every operation in its
+    own session and commits once, so a burst of writes pays for one commit instead of one each.
+    every caller gets its own result or exception. an operation that aborts (404, ...) fails alone;
+    any other error rolls the batch back and the operations are retried one transaction each.
+'''
+class GroupCommitter(object):
+
+  def __init__(self, delay_ms=GROUP_COMMIT_DELAY_MS, max_batch=GROUP_COMMIT_MAX_BATCH):
+    self.delay = delay_ms / 1000.0
+    self.max_batch = max_batch
+    self.batches = 0
+    self.writes = 0
+    self._batch = None
+    self._lock = threading.Lock()
+
+  def submit(self, operation):
+    '''runs operation() in the next group commit, returns its result or raises its error'''
+    entry = _Entry(operation)
+    with self._lock:
+      batch = self._batch
+      leader = batch is None
+      if leader:
+        batch = self._batch = _Batch()
+      batch.entries.append(entry)
+      if len(batch.entries) >= self.max_batch:
+        # later writes start the next batch
+        self._batch = None
+        batch.full.set()
+    if leader:
+      batch.full.wait(self.delay)
+      with self._lock:
+        if self._batch is batch:
+          self._batch = None
+      self._commit(batch.entries)
+    else:
+      entry.done.wait()
+    if entry.error is not None:
+      raise entry.error
+    # the leader's request did the writing, follow it to the primary all the same
+    mark_written()
+    return entry.result
+
+  def _commit(self, entries):
+    try:
+      try:
+        results = []
+        for entry in entries:
+          try:
+            results.append((entry, entry.operation()))
+          except HTTPException as error:
+            entry.error = error
+        db.session.commit()
+        for entry, result in results:
+          entry.result = result
+      except Exception:
+        db.session.rollback()
+        # find the write that failed without failing the others
+        for entry in entries:
+          entry.error = None
+          try:
+            entry.result = entry.operation()
+            db.session.commit()
+          except Exception as error:
+            db.session.rollback()
+            entry.error = error
+      with self._lock:
+        self.batches += 1
+        self.writes += len(entries)
+    finally:
+      for entry in entries:
+        entry.done.set()
+
+  def stats(self):
+    with self._lock:
+      return {
+        'batches': self.batches,
+        'writes': self.writes
+      }
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request
+
+from .replicas import served_by_replica
+
+RESPONSE_CACHE_MAX_AGE = 0
+RESPONSE_CACHE_SIZE = 512
+# seconds a kept body is served for even when no version file moved, which bounds how long writes the
+# version files do not see (another host, the async app elsewhere, migrations, manual SQL) stay hidden
+RESPONSE_CACHE_TTL = 30
+
+
+'''
+etag_of(body)
+    the strong validator of a response body: a hash of its bytes, so two workers or hosts only ever
+    give the same ETag to the same content, whatever their version files say
+'''
+def etag_of(body):
+  return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+'''
+ResponseCache
+    conditional GET for read endpoints.
+    200 bodies are kept per URL in a bounded LRU, with the data version they were built at and their
+    ETag, and served again without a query or jsonify until the data version moves on or ttl seconds
+    pass. a client that sends the ETag back in If-None-Match gets a 304, without the view running
+    when the body is kept. version is a callable returning the data version, it changes on every
+    committed write this host sees.
+'''
+class ResponseCache(object):
+
+  def __init__(self, version, max_age=RESPONSE_CACHE_MAX_AGE, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+    self.version = version
+    self.max_age = max_age
+    self.size = size
+    self.ttl = ttl
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def _finish(self, response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age={}, must-revalidate'.format(self.max_age)
+    return response
+
+  def _kept(self, key, version):
+    '''the (body, etag) kept for key at version and younger than ttl, or None'''
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      if entry[0] != version or time.time() - entry[3] >= self.ttl:
+        del self._entries[key]
+        return None
+      self._entries.move_to_end(key)
+      return entry[1], entry[2]
+
+  def cached(self, view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      version = self.version()
+      key = request.full_path
+      kept = self._kept(key, version)
+      if kept is not None:
+        body, etag = kept
+        if request.if_none_match.contains(etag):
+          return self._finish(Response(status=304), etag)
+        return self._finish(Response(body, mimetype='application/json'), etag)
+      response = view(*args, **kwargs)
+      # a replica may lag behind the version, so its body is not kept under it.
+      # streamed bodies are too big to keep, and reading them here would defeat the streaming
+      if response.status_code != 200 or response.is_streamed:
+        return response
+      body = response.get_data()
+      etag = etag_of(body)
+      if not served_by_replica():
+        with self._lock:
+          self._entries[key] = (version, body, etag, time.time())
+          self._entries.move_to_end(key)
+          while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+      if request.if_none_match.contains(etag):
+        return self._finish(Response(status=304), etag)
+      return self._finish(response, etag)
+    return wrapper
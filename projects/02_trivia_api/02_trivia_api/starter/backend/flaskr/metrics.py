@@ -0,0 +1,194 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from flask import Response, g, has_request_context, request
+from flask_cors import cross_origin
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_ENABLED = False
+PROFILING_ENABLED = False
+
+# request duration histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_engine_hooks_installed = False
+
+
+'''
+RouteStats
+    running totals for one (method, route)
+'''
+class RouteStats(object):
+
+  def __init__(self):
+    self.requests = 0
+    self.seconds = 0.0
+    self.buckets = [0] * len(BUCKETS)
+    self.db_queries = 0
+    self.db_seconds = 0.0
+    self.serialization_seconds = 0.0
+    self.response_bytes = 0
+
+  def observe(self, seconds, db_queries, db_seconds, serialization_seconds, response_bytes):
+    self.requests += 1
+    self.seconds += seconds
+    for i, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        self.buckets[i] += 1
+    self.db_queries += db_queries
+    self.db_seconds += db_seconds
+    self.serialization_seconds += serialization_seconds
+    self.response_bytes += response_bytes
+
+
+'''
+Metrics
+    per-route timings of every request: total time, DB query count and time, JSON serialization
+    time and response size, served in the Prometheus text format at /metrics.
+    with profiling on, adding ?profile=1 to any request returns its profile instead of its body.
+    nothing is hooked into the app unless it is enabled, so it costs nothing when off.
+    the numbers are per worker process, like any in-process Prometheus client.
+'''
+class Metrics(object):
+
+  def __init__(self):
+    self.routes = {}
+    self._lock = threading.Lock()
+
+  def init_app(self, app):
+    if app.config.get('METRICS_ENABLED', METRICS_ENABLED):
+      self._install_engine_hooks()
+      app.json_encoder = _timed_encoder(app.json_encoder)
+      app.before_request(self._before_request)
+      app.after_request(self._after_request)
+
+      @cross_origin()
+      def metrics():
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+      app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+
+    if app.config.get('PROFILING_ENABLED', PROFILING_ENABLED):
+      app.before_request(_start_profile)
+      app.after_request(_finish_profile)
+
+  def _install_engine_hooks(self):
+    global _engine_hooks_installed
+    if _engine_hooks_installed:
+      return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    _engine_hooks_installed = True
+
+  def _before_request(self):
+    g.metrics = {'start': time.perf_counter(), 'db_queries': 0, 'db_seconds': 0.0, 'serialization_seconds': 0.0}
+
+  def _after_request(self, response):
+    sample = g.pop('metrics', None)
+    if sample is None:
+      return response
+    seconds = time.perf_counter() - sample['start']
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    size = 0 if response.is_streamed else (response.content_length or 0)
+    with self._lock:
+      stats = self.routes.get((request.method, route))
+      if stats is None:
+        stats = self.routes[(request.method, route)] = RouteStats()
+      stats.observe(seconds, sample['db_queries'], sample['db_seconds'], sample['serialization_seconds'], size)
+    return response
+
+  def render(self):
+    with self._lock:
+      routes = sorted(self.routes.items())
+      lines = [
+        '# HELP trivia_request_duration_seconds Time spent handling requests.',
+        '# TYPE trivia_request_duration_seconds histogram'
+      ]
+      for (method, route), stats in routes:
+        labels = 'method="{}",route="{}"'.format(method, route)
+        for bound, count in zip(BUCKETS, stats.buckets):
+          lines.append('trivia_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+        lines.append('trivia_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, stats.requests))
+        lines.append('trivia_request_duration_seconds_sum{{{}}} {}'.format(labels, stats.seconds))
+        lines.append('trivia_request_duration_seconds_count{{{}}} {}'.format(labels, stats.requests))
+      for name, attribute, kind, text in (
+          ('trivia_db_queries_total', 'db_queries', 'counter', 'SQL statements executed.'),
+          ('trivia_db_query_seconds_total', 'db_seconds', 'counter', 'Time spent in SQL statements.'),
+          ('trivia_serialization_seconds_total', 'serialization_seconds', 'counter', 'Time spent encoding JSON.'),
+          ('trivia_response_bytes_total', 'response_bytes', 'counter', 'Bytes of response bodies.')):
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for (method, route), stats in routes:
+          lines.append('{}{{method="{}",route="{}"}} {}'.format(name, method, route, getattr(stats, attribute)))
+    return '\n'.join(lines) + '\n'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  starts = conn.info.get('query_start')
+  if not starts:
+    return
+  start = starts.pop()
+  if has_request_context():
+    sample = g.get('metrics')
+    if sample is not None:
+      sample['db_queries'] += 1
+      sample['db_seconds'] += time.perf_counter() - start
+
+
+def _timed_encoder(encoder):
+  class TimedJSONEncoder(encoder):
+    def encode(self, o):
+      start = time.perf_counter()
+      try:
+        return super(TimedJSONEncoder, self).encode(o)
+      finally:
+        if has_request_context():
+          sample = g.get('metrics')
+          if sample is not None:
+            sample['serialization_seconds'] += time.perf_counter() - start
+  return TimedJSONEncoder
+
+
+def _pyinstrument():
+  # imported on the first profiled request, not when the app starts
+  try:
+    import pyinstrument
+  except ImportError:
+    return None
+  return pyinstrument
+
+
+def _start_profile():
+  if request.args.get('profile') != '1':
+    return
+  pyinstrument = _pyinstrument()
+  if pyinstrument is not None:
+    profiler = pyinstrument.Profiler()
+    profiler.start()
+  else:
+    profiler = cProfile.Profile()
+    profiler.enable()
+  g.profiler = profiler
+
+
+def _finish_profile(response):
+  profiler = g.pop('profiler', None)
+  if profiler is None:
+    return response
+  if not isinstance(profiler, cProfile.Profile):
+    profiler.stop()
+    report = profiler.output_text(unicode=True)
+  else:
+    profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(40)
+    report = output.getvalue()
+  profiled = Response(report, mimetype='text/plain')
+  profiled.headers['X-Profiled-Status'] = str(response.status_code)
+  return profiled
@@ -0,0 +1,55 @@
+import base64
+import json
+from sqlalchemy import func
+
+from models import Question
+
+
+'''
+encode_cursor(after_id)
+    turns the id of the last question on a page into an opaque cursor
+'''
+def encode_cursor(after_id):
+  raw = json.dumps({'after_id': after_id}).encode('utf-8')
+  return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+'''
+decode_cursor(cursor)
+    returns the after_id stored in a cursor, raises ValueError if it is not one of ours
+'''
+def decode_cursor(cursor):
+  try:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    return int(json.loads(raw.decode('utf-8'))['after_id'])
+  except (ValueError, TypeError, KeyError):
+    raise ValueError('invalid cursor')
+
+
+'''
+count_questions(selection)
+    runs a single COUNT over the selection without loading any rows
+'''
+def count_questions(selection):
+  return selection.with_entities(func.count(Question.id)).order_by(None).scalar()
+
+
+'''
+paginate_questions(selection, per_page, page=1, after_id=None)
+    loads one page of the selection in id order.
+    page numbers use LIMIT/OFFSET, after_id uses a keyset (id > after_id) so deep pages stay cheap.
+    returns the page of questions and the cursor for the next page (None on the last page)
+'''
+def paginate_questions(selection, per_page, page=1, after_id=None):
+  selection = selection.order_by(Question.id)
+  if after_id is not None:
+    selection = selection.filter(Question.id > after_id)
+  else:
+    selection = selection.offset((page - 1) * per_page)
+  # one extra row tells us whether there is a next page
+  questions = selection.limit(per_page + 1).all()
+  next_cursor = None
+  if len(questions) > per_page:
+    questions = questions[:per_page]
+    next_cursor = encode_cursor(questions[-1].id)
+  return questions, next_cursor
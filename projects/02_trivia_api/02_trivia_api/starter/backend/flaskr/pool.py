@@ -0,0 +1,114 @@
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
+DB_POOL_PRE_PING = True
+DB_CONNECT_TIMEOUT = 10
+# milliseconds, 0 leaves the server default
+DB_STATEMENT_TIMEOUT = 30000
+
+
+'''
+TimedQueuePool
+    a QueuePool that also counts how long checkouts wait for a connection (opening a new one
+    included), how many of them time out, how many connections were opened and how often the
+    pool was invalidated by a lost connection. the counts start over when the pool is recreated.
+'''
+class TimedQueuePool(QueuePool):
+
+  def __init__(self, *args, **kwargs):
+    super(TimedQueuePool, self).__init__(*args, **kwargs)
+    self.checkouts = 0
+    self.wait_seconds = 0.0
+    self.max_wait_seconds = 0.0
+    self.timeouts = 0
+    self.connects = 0
+    self.invalidations = 0
+    self._stats_lock = threading.Lock()
+    invoke_creator = self._invoke_creator
+
+    # every new or replacement DBAPI connection is opened through here
+    def counted_creator(connection_record):
+      with self._stats_lock:
+        self.connects += 1
+      return invoke_creator(connection_record)
+    self._invoke_creator = counted_creator
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      return super(TimedQueuePool, self)._do_get()
+    except exc.TimeoutError:
+      with self._stats_lock:
+        self.timeouts += 1
+      raise
+    finally:
+      waited = time.perf_counter() - start
+      with self._stats_lock:
+        self.checkouts += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+  def _invalidate(self, connection, exception=None, _checkin=True):
+    # a disconnect seen by pre-ping or by a query, every older pooled connection is dropped
+    with self._stats_lock:
+      self.invalidations += 1
+    return super(TimedQueuePool, self)._invalidate(connection, exception, _checkin)
+
+
+'''
+engine_options(config, uri)
+    the create_engine() arguments for uri from the DB_* settings: pool sizing, pre-ping,
+    recycle, and connect and statement timeouts. SQLite keeps the Flask-SQLAlchemy defaults.
+'''
+def engine_options(config, uri):
+  if uri.startswith('sqlite'):
+    return {}
+  options = {
+    'poolclass': TimedQueuePool,
+    'pool_size': config.get('DB_POOL_SIZE', DB_POOL_SIZE),
+    'max_overflow': config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW),
+    'pool_timeout': config.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT),
+    'pool_recycle': config.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE),
+    'pool_pre_ping': config.get('DB_POOL_PRE_PING', DB_POOL_PRE_PING)
+  }
+  if uri.startswith('postgres'):
+    connect_args = {'connect_timeout': config.get('DB_CONNECT_TIMEOUT', DB_CONNECT_TIMEOUT)}
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT', DB_STATEMENT_TIMEOUT)
+    if statement_timeout:
+      connect_args['options'] = '-c statement_timeout={}'.format(statement_timeout)
+    options['connect_args'] = connect_args
+  return options
+
+
+'''
+pool_stats(pool)
+    a JSON-ready snapshot of a pool: its size and usage, plus the wait and health counters
+    when it is a TimedQueuePool
+'''
+def pool_stats(pool):
+  stats = {'pool': type(pool).__name__}
+  if isinstance(pool, QueuePool):
+    stats.update({
+      'size': pool.size(),
+      'checkedIn': pool.checkedin(),
+      'checkedOut': pool.checkedout(),
+      'overflow': max(pool.overflow(), 0),
+      'maxOverflow': pool._max_overflow
+    })
+  if isinstance(pool, TimedQueuePool):
+    with pool._stats_lock:
+      stats.update({
+        'checkouts': pool.checkouts,
+        'waitSeconds': round(pool.wait_seconds, 6),
+        'maxWaitSeconds': round(pool.max_wait_seconds, 6),
+        'timeouts': pool.timeouts,
+        'connects': pool.connects,
+        'invalidations': pool.invalidations
+      })
+  return stats
@@ -0,0 +1,223 @@
+import os
+import random
+import tempfile
+
+from models import db, Question
+from .changes import VersionedIndex
+
+QUESTION_INDEX_TTL = 300
+QUESTION_VERSION_FILE = os.path.join(tempfile.gettempdir(), 'trivia_questions.version')
+
+# pool key used for "all categories", matching quiz_category id 0 sent by the frontend
+ALL_CATEGORIES = 0
+
+# how many random draws to try before falling back to filtering the pool
+MAX_REJECTIONS = 8
+
+# the most questions one /quizzes call draws
+MAX_QUIZ_DRAW = 50
+
+DIFFICULTIES = (1, 2, 3, 4, 5)
+# where an adaptive quiz starts, before the player answered anything
+ADAPTIVE_START_DIFFICULTY = 3
+
+
+'''
+target_difficulty(answered, correct)
+    the difficulty matching a player's running accuracy: 1 at 0% right, 5 at 100%
+'''
+def target_difficulty(answered, correct):
+  if answered <= 0:
+    return ADAPTIVE_START_DIFFICULTY
+  accuracy = min(max(float(correct) / answered, 0.0), 1.0)
+  return DIFFICULTIES[0] + int(round(accuracy * (DIFFICULTIES[-1] - DIFFICULTIES[0])))
+
+
+'''
+IdPool
+    the question ids of one category, as a list for O(1) random access
+    and a dict of list positions for O(1) membership, insert and remove
+'''
+class IdPool(object):
+
+  def __init__(self):
+    self.ids = []
+    self.positions = {}
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self, question_id):
+    return question_id in self.positions
+
+  def add(self, question_id):
+    if question_id not in self.positions:
+      self.positions[question_id] = len(self.ids)
+      self.ids.append(question_id)
+
+  def remove(self, question_id):
+    position = self.positions.pop(question_id, None)
+    if position is None:
+      return
+    last = self.ids.pop()
+    if last != question_id:
+      self.ids[position] = last
+      self.positions[last] = position
+
+  def remaining(self, excluded):
+    '''how many ids of the pool are not in excluded'''
+    seen = 0
+    for question_id in excluded:
+      if question_id in self.positions:
+        seen += 1
+    return len(self.ids) - seen
+
+  def pick(self, excluded):
+    '''returns a random id not in excluded and how many such ids there were, or (None, 0)'''
+    remaining = self.remaining(excluded)
+    if remaining <= 0:
+      return None, 0
+    for _ in range(MAX_REJECTIONS):
+      question_id = self.ids[random.randrange(len(self.ids))]
+      if question_id not in excluded:
+        return question_id, remaining
+    return random.choice([i for i in self.ids if i not in excluded]), remaining
+
+  def sample(self, excluded, count):
+    '''returns up to count distinct random ids not in excluded and how many such ids there were'''
+    remaining = self.remaining(excluded)
+    count = min(count, remaining)
+    if count <= 0:
+      return [], max(remaining, 0)
+    # rejection sampling stays cheap while most of the pool is still unseen
+    if remaining >= 2 * count:
+      picked = []
+      seen = set()
+      for _ in range(MAX_REJECTIONS * count):
+        question_id = self.ids[random.randrange(len(self.ids))]
+        if question_id not in excluded and question_id not in seen:
+          seen.add(question_id)
+          picked.append(question_id)
+          if len(picked) == count:
+            return picked, remaining
+    return random.sample([i for i in self.ids if i not in excluded], count), remaining
+
+
+'''
+QuestionIdIndex
+    per-category pools of question ids, so a quiz draw never loads the questions table.
+    each category also has one pool per difficulty, keyed (category, difficulty), for adaptive quizzes.
+    pools are built from an id/category/difficulty query and updated in place by commits in this worker.
+'''
+class QuestionIdIndex(VersionedIndex):
+
+  model = Question
+
+  def __init__(self, ttl=QUESTION_INDEX_TTL, version_file=QUESTION_VERSION_FILE):
+    super(QuestionIdIndex, self).__init__(ttl, version_file)
+
+  def load(self):
+    pools = {ALL_CATEGORIES: IdPool()}
+    for question_id, category, difficulty in db.session.query(Question.id, Question.category, Question.difficulty):
+      self._add(pools, question_id, category, difficulty)
+    return pools
+
+  def pools(self):
+    return self.data()
+
+  def pick(self, category_id, previous_ids):
+    '''returns a random unseen question id of the category (0 for all) and how many were left before it'''
+    pool = self.pools().get(category_id)
+    if pool is None:
+      return None, 0
+    excluded = set(previous_ids)
+    with self._lock:
+      return pool.pick(excluded)
+
+  def sample(self, category_id, previous_ids, count):
+    '''returns up to count distinct random unseen question ids of the category (0 for all) and how many were left'''
+    pool = self.pools().get(category_id)
+    if pool is None:
+      return [], 0
+    excluded = set(previous_ids)
+    with self._lock:
+      return pool.sample(excluded, count)
+
+  def pick_adaptive(self, category_id, previous_ids, difficulty):
+    '''
+    returns a random unseen question id of the category (0 for all) at the given difficulty, or at the
+    nearest one that still has unseen questions, with the difficulty it came from and how many unseen
+    questions the category had before it
+    '''
+    pools = self.pools()
+    pool = pools.get(category_id)
+    if pool is None:
+      return None, 0, None
+    excluded = set(previous_ids)
+    with self._lock:
+      remaining = pool.remaining(excluded)
+      if remaining <= 0:
+        return None, 0, None
+      for nearest in sorted(DIFFICULTIES, key=lambda d: (abs(d - difficulty), d)):
+        bucket = pools.get((category_id, nearest))
+        if bucket is not None:
+          question_id, left = bucket.pick(excluded)
+          if question_id is not None:
+            return question_id, remaining, nearest
+      # only questions without a known difficulty are left
+      question_id, remaining = pool.pick(excluded)
+      return question_id, remaining, None
+
+  def sample_adaptive(self, category_id, previous_ids, difficulty, count):
+    '''up to count ids drawn one after the other as pick_adaptive() does, and how many were left before them'''
+    excluded = set(previous_ids)
+    ids = []
+    remaining = 0
+    for _ in range(count):
+      question_id, left, nearest = self.pick_adaptive(category_id, excluded, difficulty)
+      if not ids:
+        remaining = left
+      if question_id is None:
+        break
+      ids.append(question_id)
+      excluded.add(question_id)
+    return ids, remaining
+
+  def ids(self, category_id):
+    '''returns a copy of the question ids of the category (0 for all)'''
+    pool = self.pools().get(category_id)
+    if pool is None:
+      return []
+    with self._lock:
+      return list(pool.ids)
+
+  def discard(self, question_id):
+    with self._lock:
+      if self._data is not None:
+        for pool in self._data.values():
+          pool.remove(question_id)
+
+  def apply(self, pools, changes):
+    for operation, row in changes:
+      for pool in pools.values():
+        pool.remove(row['id'])
+      if operation != 'delete':
+        self._add(pools, row['id'], row['category'], row['difficulty'])
+    return True
+
+  def _add(self, pools, question_id, category, difficulty):
+    pools[ALL_CATEGORIES].add(question_id)
+    try:
+      difficulty = int(difficulty)
+    except (TypeError, ValueError):
+      difficulty = None
+    if difficulty is not None:
+      pools.setdefault((ALL_CATEGORIES, difficulty), IdPool()).add(question_id)
+    try:
+      category = int(category)
+    except (TypeError, ValueError):
+      return
+    pools.setdefault(category, IdPool()).add(question_id)
+    if difficulty is not None:
+      pools.setdefault((category, difficulty), IdPool()).add(question_id)
+
@@ -0,0 +1,194 @@
+import os
+import random
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+
+QUIZ_SESSION_STORE = 'memory'
+QUIZ_SESSION_MAX = 10000
+QUIZ_SESSION_TTL = 3600
+QUIZ_SESSION_DB = os.path.join(tempfile.gettempdir(), 'trivia_quiz_sessions.db')
+
+
+'''
+QuizSession
+    the questions of one quiz, drawn once as a shuffled permutation of ids.
+    next_id() walks a cursor over the permutation, so the server never keeps
+    or receives a growing list of previous questions.
+'''
+class QuizSession(object):
+
+  def __init__(self, session_id, category, question_ids, cursor=0, updated_at=None):
+    self.id = session_id
+    self.category = category
+    self.question_ids = question_ids
+    self.cursor = cursor
+    self.updated_at = updated_at or time.time()
+
+  @classmethod
+  def start(cls, category, question_ids):
+    question_ids = array('q', question_ids)
+    random.shuffle(question_ids)
+    return cls(secrets.token_urlsafe(16), category, question_ids)
+
+  def remaining(self):
+    return len(self.question_ids) - self.cursor
+
+  def next_id(self):
+    if self.cursor >= len(self.question_ids):
+      return None
+    question_id = self.question_ids[self.cursor]
+    self.cursor += 1
+    self.updated_at = time.time()
+    return question_id
+
+
+'''
+SessionStore
+    where quiz sessions live between requests. backends implement get, put, advance and delete.
+'''
+class SessionStore(object):
+
+  def get(self, session_id):
+    raise NotImplementedError
+
+  def put(self, session):
+    raise NotImplementedError
+
+  def advance(self, session_id):
+    '''
+    moves the session's cursor on by one, atomically, so concurrent requests never get the same
+    question. returns the id it passed (None at the end) and how many are left after it, or
+    raises KeyError when there is no such session
+    '''
+    raise NotImplementedError
+
+  def delete(self, session_id):
+    raise NotImplementedError
+
+
+'''
+MemorySessionStore
+    keeps up to max_sessions sessions in this process and evicts the least recently used one
+'''
+class MemorySessionStore(SessionStore):
+
+  def __init__(self, max_sessions=QUIZ_SESSION_MAX, ttl=QUIZ_SESSION_TTL):
+    self.max_sessions = max_sessions
+    self.ttl = ttl
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, session_id):
+    with self._lock:
+      session = self._sessions.get(session_id)
+      if session is None:
+        return None
+      if time.time() - session.updated_at > self.ttl:
+        del self._sessions[session_id]
+        return None
+      self._sessions.move_to_end(session_id)
+      return session
+
+  def put(self, session):
+    with self._lock:
+      self._sessions[session.id] = session
+      self._sessions.move_to_end(session.id)
+      while len(self._sessions) > self.max_sessions:
+        self._sessions.popitem(last=False)
+
+  def advance(self, session_id):
+    session = self.get(session_id)
+    if session is None:
+      raise KeyError(session_id)
+    with self._lock:
+      return session.next_id(), session.remaining()
+
+  def delete(self, session_id):
+    with self._lock:
+      self._sessions.pop(session_id, None)
+
+
+'''
+SQLiteSessionStore
+    keeps sessions in a local SQLite file, so every worker on the host shares them
+    without an external service. the permutation is stored as a packed array of ids.
+'''
+class SQLiteSessionStore(SessionStore):
+
+  def __init__(self, path=QUIZ_SESSION_DB, ttl=QUIZ_SESSION_TTL):
+    self.path = path
+    self.ttl = ttl
+    with self._connect() as connection:
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS quiz_sessions ('
+        ' id TEXT PRIMARY KEY, category INTEGER, cursor INTEGER,'
+        ' question_ids BLOB, updated_at REAL)')
+      connection.execute(
+        'CREATE INDEX IF NOT EXISTS quiz_sessions_updated_at ON quiz_sessions (updated_at)')
+
+  @contextmanager
+  def _connect(self):
+    connection = sqlite3.connect(self.path, timeout=5)
+    try:
+      with connection:
+        yield connection
+    finally:
+      connection.close()
+
+  def get(self, session_id):
+    with self._connect() as connection:
+      row = connection.execute(
+        'SELECT category, cursor, question_ids, updated_at FROM quiz_sessions WHERE id = ?',
+        (session_id,)).fetchone()
+    if row is None or time.time() - row[3] > self.ttl:
+      return None
+    question_ids = array('q')
+    question_ids.frombytes(row[2])
+    return QuizSession(session_id, row[0], question_ids, row[1], row[3])
+
+  def put(self, session):
+    with self._connect() as connection:
+      connection.execute(
+        'INSERT OR REPLACE INTO quiz_sessions (id, category, cursor, question_ids, updated_at)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        (session.id, session.category, session.cursor, session.question_ids.tobytes(), session.updated_at))
+      connection.execute('DELETE FROM quiz_sessions WHERE updated_at < ?', (time.time() - self.ttl,))
+
+  def advance(self, session_id):
+    while True:
+      session = self.get(session_id)
+      if session is None:
+        raise KeyError(session_id)
+      if session.remaining() <= 0:
+        return None, 0
+      with self._connect() as connection:
+        moved = connection.execute(
+          'UPDATE quiz_sessions SET cursor = cursor + 1, updated_at = ? WHERE id = ? AND cursor = ?',
+          (time.time(), session_id, session.cursor)).rowcount
+      if moved:
+        return session.question_ids[session.cursor], session.remaining() - 1
+      # another request moved the cursor first, read it again
+
+  def delete(self, session_id):
+    with self._connect() as connection:
+      connection.execute('DELETE FROM quiz_sessions WHERE id = ?', (session_id,))
+
+
+'''
+create_session_store(config)
+    builds the store named by QUIZ_SESSION_STORE ('memory' or 'sqlite')
+'''
+def create_session_store(config):
+  kind = config.get('QUIZ_SESSION_STORE', QUIZ_SESSION_STORE)
+  ttl = config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL)
+  if kind == 'memory':
+    return MemorySessionStore(config.get('QUIZ_SESSION_MAX', QUIZ_SESSION_MAX), ttl)
+  if kind == 'sqlite':
+    return SQLiteSessionStore(config.get('QUIZ_SESSION_DB', QUIZ_SESSION_DB), ttl)
+  raise ValueError('unknown quiz session store: {}'.format(kind))
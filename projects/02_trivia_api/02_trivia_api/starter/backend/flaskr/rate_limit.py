@@ -0,0 +1,199 @@
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import abort, g, request
+
+# off unless the deployment turns it on: the budgets below are tight enough to throttle a normal quiz in the
+# frontend, so they are meant to be tuned (RATE_LIMITS) for the traffic behind them before enabling
+RATE_LIMIT_ENABLED = False
+RATE_LIMIT_STORE = 'memory'
+RATE_LIMIT_DB = os.path.join(tempfile.gettempdir(), 'trivia_rate_limits.db')
+RATE_LIMIT_MAX_KEYS = 100000
+# concurrent requests one worker accepts before it sheds new ones, 0 to never shed
+LOAD_SHED_MAX_IN_FLIGHT = 64
+# proxies in front of the app that append to X-Forwarded-For. 0 trusts no header and keys clients on the
+# socket address, which behind a load balancer or CDN is the proxy's, so every user would share one bucket
+PROXY_FIX_HOPS = 0
+
+# route -> (tokens refilled per second, bucket size); 'default' covers every other route
+RATE_LIMITS = {
+  'default': (10, 40),
+  '/quizzes': (2, 10),
+  '/questions/search': (2, 10),
+  '/quizzes/sessions': (1, 5),
+  # the players of a room often share one address (venue wifi) and all answer within seconds
+  '/rooms/<room_id>/players': (50, 500),
+  '/rooms/<room_id>/events': (50, 500),
+  '/rooms/<room_id>/answers': (100, 1000)
+}
+
+# never limited: health checks, scraping and CORS preflights
+EXEMPT_ROUTES = ('/health', '/metrics')
+
+
+'''
+refill(tokens, updated_at, now, rate, capacity)
+    the token bucket arithmetic shared by the stores: returns the tokens left after taking one
+    (or the unchanged count when empty) and how many seconds until the next token
+'''
+def refill(tokens, updated_at, now, rate, capacity):
+  tokens = min(capacity, tokens + max(now - updated_at, 0) * rate)
+  if tokens >= 1:
+    return tokens - 1, 0
+  return tokens, (1 - tokens) / rate
+
+
+'''
+BucketStore
+    where token buckets live between requests. take(key, rate, capacity) spends one token
+    of key's bucket and returns (allowed, retry_after seconds). backends implement take.
+'''
+class BucketStore(object):
+
+  def take(self, key, rate, capacity):
+    raise NotImplementedError
+
+
+'''
+MemoryBucketStore
+    buckets in this process, the least recently used ones dropped beyond max_keys
+    (a dropped bucket comes back full, the same as one that was idle long enough)
+'''
+class MemoryBucketStore(BucketStore):
+
+  def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+    self.max_keys = max_keys
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def take(self, key, rate, capacity):
+    now = time.time()
+    with self._lock:
+      tokens, updated_at = self._buckets.get(key, (capacity, now))
+      tokens, retry_after = refill(tokens, updated_at, now, rate, capacity)
+      self._buckets[key] = (tokens, now)
+      self._buckets.move_to_end(key)
+      while len(self._buckets) > self.max_keys:
+        self._buckets.popitem(last=False)
+    return retry_after == 0, retry_after
+
+
+'''
+SQLiteBucketStore
+    buckets in a local SQLite file shared by every worker on the host. each take is one
+    write transaction, so concurrent workers never spend the same token twice.
+'''
+class SQLiteBucketStore(BucketStore):
+
+  def __init__(self, path=RATE_LIMIT_DB):
+    self.path = path
+    with self._connect() as connection:
+      connection.execute(
+        'CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)')
+
+  @contextmanager
+  def _connect(self):
+    connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+    try:
+      yield connection
+    finally:
+      connection.close()
+
+  def take(self, key, rate, capacity):
+    now = time.time()
+    with self._connect() as connection:
+      connection.execute('BEGIN IMMEDIATE')
+      try:
+        row = connection.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (key,)).fetchone()
+        tokens, updated_at = row if row is not None else (capacity, now)
+        tokens, retry_after = refill(tokens, updated_at, now, rate, capacity)
+        connection.execute('INSERT OR REPLACE INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)',
+                           (key, tokens, now))
+        # buckets idle long enough to be full again carry no state
+        connection.execute('DELETE FROM rate_limits WHERE updated_at < ?', (now - 3600,))
+        connection.execute('COMMIT')
+      except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    return retry_after == 0, retry_after
+
+
+'''
+create_bucket_store(config)
+    builds the store named by RATE_LIMIT_STORE ('memory' or 'sqlite'), or returns it as is
+    when it is already a BucketStore, which is how a shared backend (Redis, ...) is plugged in
+'''
+def create_bucket_store(config):
+  kind = config.get('RATE_LIMIT_STORE', RATE_LIMIT_STORE)
+  if isinstance(kind, BucketStore):
+    return kind
+  if kind == 'memory':
+    return MemoryBucketStore(config.get('RATE_LIMIT_MAX_KEYS', RATE_LIMIT_MAX_KEYS))
+  if kind == 'sqlite':
+    return SQLiteBucketStore(config.get('RATE_LIMIT_DB', RATE_LIMIT_DB))
+  raise ValueError('unknown rate limit store: {}'.format(kind))
+
+
+'''
+RateLimiter
+    per-client token buckets with a budget per route, answering 429 with Retry-After when a
+    bucket is empty. clients are keyed by g.auth_subject when an authentication layer has set it
+    and by IP address otherwise. it also sheds load: when a worker is already handling
+    max_in_flight requests, new ones get an immediate 503 instead of queueing until they time out.
+'''
+class RateLimiter(object):
+
+  def __init__(self, store, limits=None, max_in_flight=LOAD_SHED_MAX_IN_FLIGHT):
+    self.store = store
+    self.limits = dict(RATE_LIMITS)
+    self.limits.update(limits or {})
+    self.max_in_flight = max_in_flight
+    self.in_flight = 0
+    self._lock = threading.Lock()
+
+  def init_app(self, app):
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+    app.teardown_request(self._teardown_request)
+
+  def key(self):
+    subject = g.get('auth_subject')
+    if subject:
+      return 'subject:{}'.format(subject)
+    return 'ip:{}'.format(request.remote_addr)
+
+  def _before_request(self):
+    if request.method == 'OPTIONS':
+      return
+    route = request.url_rule.rule if request.url_rule is not None else None
+    if route in EXEMPT_ROUTES:
+      return
+    if self.max_in_flight:
+      with self._lock:
+        if self.in_flight >= self.max_in_flight:
+          g.retry_after = 1
+          abort(503)
+        self.in_flight += 1
+      g.counted_in_flight = True
+    rate, capacity = self.limits.get(route, self.limits['default'])
+    budget = route if route in self.limits else 'default'
+    allowed, retry_after = self.store.take('{}|{}'.format(self.key(), budget), rate, capacity)
+    if not allowed:
+      g.retry_after = max(int(math.ceil(retry_after)), 1)
+      abort(429)
+
+  def _after_request(self, response):
+    retry_after = g.get('retry_after')
+    if retry_after is not None and response.status_code in (429, 503):
+      response.headers['Retry-After'] = str(retry_after)
+    return response
+
+  def _teardown_request(self, error):
+    if g.pop('counted_in_flight', False):
+      with self._lock:
+        self.in_flight -= 1
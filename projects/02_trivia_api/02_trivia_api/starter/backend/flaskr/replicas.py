@@ -0,0 +1,153 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_request_context, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql.dml import UpdateBase
+
+from .pool import engine_options
+
+REPLICA_STRATEGY = 'round_robin'
+REPLICA_STICKY_SECONDS = 5
+STRATEGIES = ('round_robin', 'least_loaded')
+
+# holds the time until which a client that just wrote reads from the primary
+STICKY_COOKIE = 'trivia_primary_until'
+
+_state = threading.local()
+
+
+'''
+on_primary()
+    runs the block's reads on the primary even inside a replica-routed handler,
+    for data that is cached by version and must not be loaded from a lagging replica
+'''
+@contextmanager
+def on_primary():
+  previous = getattr(_state, 'primary', False)
+  _state.primary = True
+  try:
+    yield
+  finally:
+    _state.primary = previous
+
+
+'''
+keep_routing(function)
+    function wrapped to read where the current handler reads, replica or primary, whenever it is
+    called: the later batches of a streamed response are loaded after the handler has returned
+'''
+def keep_routing(function):
+  replica = getattr(_state, 'replica', False)
+
+  @wraps(function)
+  def wrapper(*args, **kwargs):
+    previous = getattr(_state, 'replica', False)
+    _state.replica = replica
+    try:
+      return function(*args, **kwargs)
+    finally:
+      _state.replica = previous
+  return wrapper
+
+
+'''
+served_by_replica()
+    whether the current request read anything from a replica, so its result may lag behind
+    the data version and must not be cached under it
+'''
+def served_by_replica():
+  return has_request_context() and g.get('replica_read', False)
+
+
+'''
+mark_written()
+    records that the current request wrote, for writes another thread committed on its behalf,
+    so the client reads its own writes from the primary
+'''
+def mark_written():
+  if has_request_context():
+    g.db_wrote = True
+
+
+'''
+ReplicaRouter
+    sends the reads of handlers wrapped with reads() to read replicas, picked round robin or by
+    the fewest connections in use, and everything else (writes, flushes, other handlers) to the
+    primary. a client that wrote gets a cookie that keeps its reads on the primary for
+    sticky_seconds, so it reads its own writes even when the replicas lag.
+    with no replica URLs it routes nothing and every query uses the primary.
+'''
+class ReplicaRouter(object):
+
+  def __init__(self, urls=(), strategy=REPLICA_STRATEGY, sticky_seconds=REPLICA_STICKY_SECONDS, config=None):
+    if strategy not in STRATEGIES:
+      raise ValueError('unknown replica strategy: {}'.format(strategy))
+    self.strategy = strategy
+    self.sticky_seconds = sticky_seconds
+    self.engines = [create_engine(url, **engine_options(config or {}, url)) for url in urls]
+    self._active = [0] * len(self.engines)
+    self._lock = threading.Lock()
+    self._turns = itertools.count()
+    for position, engine in enumerate(self.engines):
+      event.listen(engine, 'checkout', self._counter(position, 1))
+      event.listen(engine, 'checkin', self._counter(position, -1))
+
+  def _counter(self, position, step):
+    def count(*args):
+      with self._lock:
+        self._active[position] += step
+    return count
+
+  def init_app(self, app):
+    app.replica_router = self
+    app.after_request(self._after_request)
+
+  def choose(self):
+    '''returns the replica engine for the next read'''
+    turn = next(self._turns)
+    if self.strategy == 'least_loaded':
+      with self._lock:
+        active = list(self._active)
+      # ties go round robin, so idle replicas share the load
+      return self.engines[min(range(len(active)), key=lambda i: (active[i], (i - turn) % len(active)))]
+    return self.engines[turn % len(self.engines)]
+
+  def get_bind(self, session, clause=None):
+    '''the engine for a statement of session, or None for the primary'''
+    if session._flushing or isinstance(clause, UpdateBase):
+      mark_written()
+      return None
+    if not getattr(_state, 'replica', False) or getattr(_state, 'primary', False):
+      return None
+    if has_request_context():
+      g.replica_read = True
+    return self.choose()
+
+  def _sticky(self):
+    try:
+      return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+      return False
+
+  def reads(self, view):
+    '''routes the reads of view to the replicas, unless the client wrote in the last sticky_seconds'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      if not self.engines or self._sticky():
+        return view(*args, **kwargs)
+      previous = getattr(_state, 'replica', False)
+      _state.replica = True
+      try:
+        return view(*args, **kwargs)
+      finally:
+        _state.replica = previous
+    return wrapper
+
+  def _after_request(self, response):
+    if self.engines and self.sticky_seconds and g.get('db_wrote', False):
+      response.set_cookie(STICKY_COOKIE, str(time.time() + self.sticky_seconds),
+                          max_age=self.sticky_seconds, httponly=True, samesite='Lax')
+    return response
@@ -0,0 +1,238 @@
+import heapq
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .quiz_sessions import QuizSession
+from .serialization import dumps
+
+ROOM_MAX = 1000
+ROOM_TTL = 3600
+# events kept per room for subscribers that reconnect with Last-Event-ID
+ROOM_EVENT_HISTORY = 16
+ROOM_LEADERBOARD_SIZE = 10
+# longer player names are cut to this many characters
+MAX_PLAYER_NAME = 40
+ROOM_KEEPALIVE_SECONDS = 15
+ROOM_STREAM_SECONDS = 300
+
+
+def _normalize(answer):
+  return ' '.join(str(answer or '').split()).casefold()
+
+
+class _Player(object):
+
+  def __init__(self, number, name):
+    self.number = number
+    self.name = name
+    self.score = 0
+
+
+'''
+Room
+    a multiplayer quiz: the host moves every player to the next question at once, and players
+    answer it until the host moves on. questions are drawn like a quiz session's, and each round
+    loads its question once for the whole room.
+
+    every change is published as a server-sent event, encoded once into the room's short event log;
+    subscribers wait on the room's condition and write the same bytes, so a round costs one fetch
+    and one encoding however many players are listening.
+'''
+class Room(object):
+
+  def __init__(self, room_id, host_token, quiz, history=ROOM_EVENT_HISTORY,
+               leaderboard_size=ROOM_LEADERBOARD_SIZE):
+    self.id = room_id
+    self.host_token = host_token
+    self.quiz = quiz
+    self.leaderboard_size = leaderboard_size
+    self.round = 0
+    self.finished = False
+    self.subscribers = 0
+    self.updated_at = time.time()
+    self._players = {}
+    self._question = None
+    self._answers = {}
+    self._seq = 0
+    self._events = deque(maxlen=history)
+    self._changed = threading.Condition(threading.Lock())
+
+  @classmethod
+  def start(cls, category, question_ids, **options):
+    return cls(secrets.token_urlsafe(8), secrets.token_urlsafe(16), QuizSession.start(category, question_ids),
+               **options)
+
+  def is_host(self, token):
+    return secrets.compare_digest(str(token or '').encode('utf-8'), self.host_token.encode('utf-8'))
+
+  def join(self, name):
+    '''adds a player, returns the token it answers with and its number on the leaderboard'''
+    token = secrets.token_urlsafe(16)
+    with self._changed:
+      player = self._players[token] = _Player(len(self._players) + 1, name)
+      self.updated_at = time.time()
+    return token, player.number
+
+  def player_count(self):
+    return len(self._players)
+
+  def answer(self, token, round_number, answer):
+    '''
+    records the player's first answer to round_number. raises KeyError for an unknown player and returns
+    False when round_number is not the open one
+    '''
+    with self._changed:
+      if token not in self._players:
+        raise KeyError(token)
+      if self.finished or self._question is None or round_number != self.round:
+        return False
+      self._answers.setdefault(token, _normalize(answer))
+      self.updated_at = time.time()
+      return True
+
+  def next_round(self, load_rows):
+    '''
+    closes the open round with a "results" event and opens the next with a "question" event, or
+    ends the room with a "finished" event. load_rows(ids) returns {id: question_rows() tuple} and is
+    called once per round, skipping questions deleted since the room started.
+    returns the new question row, or None when the room is finished
+    '''
+    with self._changed:
+      if self.finished:
+        return None
+      if self._question is not None:
+        self._close_round()
+      row = None
+      while row is None:
+        question_id = self.quiz.next_id()
+        if question_id is None:
+          break
+        row = load_rows([question_id]).get(question_id)
+      self.updated_at = time.time()
+      if row is None:
+        self.finished = True
+        self._question = None
+        self._publish('finished', {'leaderboard': self.leaderboard()})
+        return None
+      self.round += 1
+      self._question = row
+      self._answers = {}
+      self._publish('question', {
+        'round': self.round,
+        'question': {'id': row[0], 'question': row[1], 'category': row[3], 'difficulty': row[4]},
+        'players': len(self._players),
+        'remainingQuestions': self.quiz.remaining()
+      })
+      return row
+
+  def _close_round(self):
+    expected = _normalize(self._question[2])
+    correct = 0
+    for token, answer in self._answers.items():
+      if answer == expected:
+        self._players[token].score += 1
+        correct += 1
+    self._publish('results', {
+      'round': self.round,
+      'answer': self._question[2],
+      'answers': len(self._answers),
+      'correct': correct,
+      'leaderboard': self.leaderboard()
+    })
+
+  def leaderboard(self):
+    best = heapq.nlargest(self.leaderboard_size, self._players.values(), key=lambda p: (p.score, -p.number))
+    return [{'player': p.number, 'name': p.name, 'score': p.score} for p in best]
+
+  def _publish(self, kind, data):
+    self._seq += 1
+    self._events.append((self._seq, 'id: {}\nevent: {}\ndata: '.format(self._seq, kind).encode('utf-8') +
+                         dumps(data) + b'\n\n'))
+    self._changed.notify_all()
+
+  def events_after(self, seq, timeout):
+    '''
+    the sequence number of the last event and the encoded events after seq, waiting up to timeout
+    seconds for one. no events on timeout
+    '''
+    with self._changed:
+      if self._seq <= seq and not self.finished:
+        self._changed.wait(timeout)
+      return self._seq, [payload for event_seq, payload in self._events if event_seq > seq]
+
+  def last_seq(self):
+    return self._seq
+
+  def subscribe(self, delta):
+    with self._changed:
+      self.subscribers += delta
+
+
+'''
+stream_room(room, last_seq, keepalive_seconds, stream_seconds)
+    the server-sent events of room after last_seq, for one subscriber. it ends once the room is
+    finished and sent, or after stream_seconds, and the client reconnects with Last-Event-ID
+'''
+def stream_room(room, last_seq=None, keepalive_seconds=ROOM_KEEPALIVE_SECONDS,
+                stream_seconds=ROOM_STREAM_SECONDS):
+  if last_seq is None:
+    # a new subscriber starts at the open round, not at the rounds before it
+    last_seq = max(room.last_seq() - 1, 0) if room.round else 0
+  started = time.time()
+  room.subscribe(1)
+  try:
+    yield b'retry: 1000\n\n'
+    while True:
+      last_seq, events = room.events_after(last_seq, keepalive_seconds)
+      if events:
+        yield b''.join(events)
+      elif room.finished:
+        return
+      else:
+        yield b': keepalive\n\n'
+      if time.time() - started >= stream_seconds:
+        return
+  finally:
+    room.subscribe(-1)
+
+
+'''
+RoomStore
+    the rooms of this worker, up to max_rooms of them, forgetting the least recently used one
+    and rooms idle for ttl seconds
+'''
+class RoomStore(object):
+
+  def __init__(self, max_rooms=ROOM_MAX, ttl=ROOM_TTL):
+    self.max_rooms = max_rooms
+    self.ttl = ttl
+    self._rooms = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, room_id):
+    with self._lock:
+      room = self._rooms.get(room_id)
+      if room is None:
+        return None
+      if time.time() - room.updated_at > self.ttl:
+        del self._rooms[room_id]
+        return None
+      self._rooms.move_to_end(room_id)
+      return room
+
+  def put(self, room):
+    with self._lock:
+      self._rooms[room.id] = room
+      self._rooms.move_to_end(room.id)
+      while len(self._rooms) > self.max_rooms:
+        self._rooms.popitem(last=False)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'rooms': len(self._rooms),
+        'players': sum(room.player_count() for room in self._rooms.values()),
+        'subscribers': sum(room.subscribers for room in self._rooms.values())
+      }
@@ -0,0 +1,243 @@
+import math
+import re
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from sqlalchemy import func, literal_column, text
+
+from models import db, Question
+from .changes import VersionedIndex
+from .pagination import count_questions
+from .quiz import QUESTION_VERSION_FILE
+
+SEARCH_BACKEND = 'auto'
+SEARCH_INDEX_TTL = 300
+SEARCH_CACHE_SIZE = 1024
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(value):
+  return TOKEN.findall((value or '').lower())
+
+
+'''
+SearchData
+    the inverted index itself: token -> {question id: term frequency}, the category, length and
+    distinct tokens of every question, and the sorted list of tokens used to expand prefixes.
+'''
+class SearchData(object):
+
+  def __init__(self):
+    self.postings = {}
+    self.documents = {}
+    self.tokens = []
+    self.total_length = 0
+
+  def add(self, question_id, question, category):
+    self.remove(question_id)
+    tokens = tokenize(question)
+    try:
+      category = int(category)
+    except (TypeError, ValueError):
+      category = None
+    self.documents[question_id] = (category, len(tokens), frozenset(tokens))
+    self.total_length += len(tokens)
+    for token in tokens:
+      posting = self.postings.get(token)
+      if posting is None:
+        posting = self.postings[token] = {}
+        insort(self.tokens, token)
+      posting[question_id] = posting.get(question_id, 0) + 1
+
+  def remove(self, question_id):
+    document = self.documents.pop(question_id, None)
+    if document is None:
+      return
+    self.total_length -= document[1]
+    for token in document[2]:
+      posting = self.postings[token]
+      del posting[question_id]
+      if not posting:
+        del self.postings[token]
+        del self.tokens[bisect_left(self.tokens, token)]
+
+  def expand(self, prefix):
+    '''returns every indexed token starting with prefix'''
+    start = bisect_left(self.tokens, prefix)
+    end = start
+    while end < len(self.tokens) and self.tokens[end].startswith(prefix):
+      end += 1
+    return self.tokens[start:end]
+
+  def rank(self, term, category=None):
+    '''returns the matching question ids of the category (every category when None), best first'''
+    documents = self.documents
+    tokens = tokenize(term)
+    if not tokens:
+      return sorted(i for i, document in documents.items() if category is None or document[0] == category)
+    average_length = max(float(self.total_length) / max(len(documents), 1), 1)
+    scores = None
+    for token in set(tokens):
+      matches = {}
+      for expanded in self.expand(token):
+        posting = self.postings[expanded]
+        idf = math.log(1 + (len(documents) - len(posting) + 0.5) / (len(posting) + 0.5))
+        for question_id, frequency in posting.items():
+          document = documents[question_id]
+          if category is not None and document[0] != category:
+            continue
+          norm = K1 * (1 - B + B * document[1] / average_length)
+          matches[question_id] = matches.get(question_id, 0) + idf * frequency * (K1 + 1) / (frequency + norm)
+      if scores is None:
+        scores = matches
+      else:
+        scores = dict((i, score + matches[i]) for i, score in scores.items() if i in matches)
+      if not scores:
+        return []
+    return sorted(scores, key=lambda i: (-scores[i], i))
+
+
+'''
+InvertedIndex
+    pure-Python full-text search for SQLite and tests.
+    every query token matches the indexed tokens it is a prefix of, a question must match
+    every query token, and results are ranked with BM25.
+'''
+class InvertedIndex(VersionedIndex):
+
+  model = Question
+
+  def __init__(self, ttl=SEARCH_INDEX_TTL, version_file=QUESTION_VERSION_FILE):
+    super(InvertedIndex, self).__init__(ttl, version_file)
+
+  def load(self):
+    data = SearchData()
+    for question_id, question, category in db.session.query(Question.id, Question.question, Question.category):
+      data.add(question_id, question, category)
+    return data
+
+  def apply(self, data, changes):
+    for operation, row in changes:
+      if operation == 'delete':
+        data.remove(row['id'])
+      else:
+        data.add(row['id'], row['question'], row['category'])
+    return True
+
+  def rank(self, term, category=None):
+    '''returns the matching question ids of the category (every category when None), best first'''
+    data = self.data()
+    with self._lock:
+      return data.rank(term, category)
+
+  def search(self, term, category=None, page=None, per_page=10):
+    '''returns a page of matching questions (every match when page is None) and the number of matches'''
+    ranked = self.rank(term, category)
+    if page is not None:
+      ids = ranked[(page - 1) * per_page:page * per_page]
+    else:
+      ids = ranked
+    questions = {}
+    if ids:
+      for question in Question.query.filter(Question.id.in_(ids)).all():
+        questions[question.id] = question
+    return [questions[i] for i in ids if i in questions], len(ranked)
+
+
+'''
+PostgresSearch
+    full-text search on Postgres with a GIN index over to_tsvector(question).
+    Postgres keeps the index current itself on every insert and delete.
+    it uses the 'simple' configuration: 'english' drops stopwords, so searching for "what" or
+    "who" would match nothing, where the substring search it replaced found them.
+'''
+class PostgresSearch(object):
+
+  # inlined rather than bound, so queries repeat the indexed expression exactly
+  config = literal_column("'simple'")
+
+  def ensure_index(self):
+    # the index of the 'english' configuration, which queries no longer use
+    db.session.execute(text("DROP INDEX IF EXISTS questions_question_fts"))
+    db.session.execute(text(
+      "CREATE INDEX IF NOT EXISTS questions_question_simple_fts ON questions "
+      "USING gin (to_tsvector('simple', coalesce(question, '')))"))
+    db.session.commit()
+
+  def match(self, term):
+    '''returns the (filter, rank) expressions for term, or None when it has no words to match'''
+    tokens = tokenize(term)
+    if not tokens:
+      return None
+    document = func.to_tsvector(self.config, func.coalesce(Question.question, ''))
+    query = func.to_tsquery(self.config, ' & '.join(token + ':*' for token in tokens))
+    return document.op('@@')(query), func.ts_rank(document, query)
+
+  def search(self, term, category=None, page=None, per_page=10):
+    selection = Question.query
+    if category is not None:
+      selection = selection.filter(Question.category == category)
+    match = self.match(term)
+    if match is None:
+      ordered = selection.order_by(Question.id)
+    else:
+      selection = selection.filter(match[0])
+      ordered = selection.order_by(match[1].desc(), Question.id)
+    if page is not None:
+      ordered = ordered.offset((page - 1) * per_page).limit(per_page)
+    return ordered.all(), count_questions(selection)
+
+
+'''
+SearchResultCache
+    a bounded LRU of search responses keyed by (term, category, page).
+    any committed question write empties it, in this worker through the commit hooks
+    and in the others through the shared question version file.
+'''
+class SearchResultCache(VersionedIndex):
+
+  model = Question
+
+  def __init__(self, size=SEARCH_CACHE_SIZE, ttl=SEARCH_INDEX_TTL, version_file=QUESTION_VERSION_FILE):
+    super(SearchResultCache, self).__init__(ttl, version_file)
+    self.size = size
+
+  def load(self):
+    return OrderedDict()
+
+  def get(self, key):
+    entries = self.data()
+    with self._lock:
+      value = entries.get(key)
+      if value is not None:
+        entries.move_to_end(key)
+      return value
+
+  def put(self, key, value):
+    entries = self.data()
+    with self._lock:
+      entries[key] = value
+      entries.move_to_end(key)
+      while len(entries) > self.size:
+        entries.popitem(last=False)
+
+
+'''
+create_search(config)
+    picks the search backend named by SEARCH_BACKEND ('postgres', 'memory' or 'auto' to follow the database)
+'''
+def create_search(config):
+  backend = config.get('SEARCH_BACKEND', SEARCH_BACKEND)
+  if backend == 'auto':
+    uri = config.get('SQLALCHEMY_DATABASE_URI') or ''
+    backend = 'postgres' if uri.startswith('postgres') else 'memory'
+  if backend == 'postgres':
+    return PostgresSearch()
+  if backend == 'memory':
+    return InvertedIndex(config.get('SEARCH_INDEX_TTL', SEARCH_INDEX_TTL),
+                         config.get('QUESTION_VERSION_FILE', QUESTION_VERSION_FILE))
+  raise ValueError('unknown search backend: {}'.format(backend))
@@ -0,0 +1,126 @@
+import json
+import re
+import time
+from collections import OrderedDict
+from flask import Response, current_app, g, has_request_context, stream_with_context
+
+from models import Question
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# lists longer than this are streamed instead of built in memory
+STREAM_THRESHOLD = 1000
+STREAM_BATCH_SIZE = 500
+
+# characters json.dumps() escapes when ensure_ascii is on, and orjson writes as UTF-8
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+
+
+'''
+question_rows(selection)
+    the selection as plain (id, question, answer, category, difficulty) tuples, no ORM objects
+'''
+def question_rows(selection):
+  return selection.with_entities(*QUESTION_COLUMNS)
+
+
+'''
+question_rows_by_id(ids)
+    the question_rows() of ids from one IN query, as {id: row}; ids that do not exist are left out
+'''
+def question_rows_by_id(ids):
+  if not ids:
+    return {}
+  return dict((row[0], row) for row in question_rows(Question.query.filter(Question.id.in_(ids))))
+
+
+'''
+question_ids(value, limit)
+    the ids of a request body's list, first occurrence of each in order. raises ValueError unless
+    value is a list of at most limit integers (booleans and numeric strings are not ids)
+'''
+def question_ids(value, limit):
+  if not isinstance(value, list) or len(value) > limit:
+    raise ValueError('ids must be a list of at most {} integers'.format(limit))
+  if not all(isinstance(i, int) and not isinstance(i, bool) for i in value):
+    raise ValueError('ids must be integers')
+  return list(OrderedDict.fromkeys(value))
+
+
+'''
+format_row(row)
+    the same dict as Question.format(), from a question_rows() tuple
+'''
+def format_row(row):
+  return {
+    'id': row[0],
+    'question': row[1],
+    'answer': row[2],
+    'category': row[3],
+    'difficulty': row[4]
+  }
+
+
+def _escape_non_ascii(match):
+  # json.dumps() writes characters outside the BMP as a surrogate pair
+  encoded = match.group(0).encode('utf-16-be')
+  return ''.join('\\u{:04x}'.format(int.from_bytes(encoded[i:i + 2], 'big')) for i in range(0, len(encoded), 2))
+
+
+'''
+dumps(value)
+    encodes value like jsonify() does (sorted keys, compact, non-ASCII escaped unless JSON_AS_ASCII
+    is off), with orjson when it is installed. the bytes are the same either way, so are the ETags
+    hashed from them. returns bytes
+'''
+def dumps(value):
+  start = time.perf_counter()
+  if orjson is not None:
+    encoded = orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    if current_app.config['JSON_AS_ASCII'] and not encoded.isascii():
+      # non-ASCII only occurs inside strings, where an escape means the same character
+      encoded = _NON_ASCII.sub(_escape_non_ascii, encoded.decode('utf-8')).encode('ascii')
+  else:
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'),
+                         ensure_ascii=current_app.config['JSON_AS_ASCII']).encode('utf-8')
+  if has_request_context():
+    sample = g.get('metrics')
+    if sample is not None:
+      sample['serialization_seconds'] += time.perf_counter() - start
+  return encoded
+
+
+'''
+json_response(value, status)
+    a drop-in for jsonify() on the hot paths, skipping Flask's encoder class
+'''
+def json_response(value, status=200):
+  return Response(dumps(value) + b'\n', status=status, mimetype='application/json')
+
+
+'''
+stream_questions(head, rows, more, tail)
+    streams {head..., "questions": [...], tail...} as chunked JSON. rows are the question_rows()
+    already loaded, more(after_id) loads the next batch after an id. the keys of head must sort
+    before "questions" and those of tail after it, so the output matches json_response(); tail is
+    a function of the number of questions sent, for totals only known at the end.
+'''
+def stream_questions(head, rows, more, tail):
+  def generate():
+    prefix = dumps(head)[:-1]
+    yield prefix + (b',' if head else b'') + b'"questions":['
+    batch = rows
+    sent = 0
+    while batch:
+      chunk = b','.join(dumps(format_row(row)) for row in batch)
+      yield (b',' if sent else b'') + chunk
+      sent += len(batch)
+      batch = more(batch[-1][0])
+    suffix = dumps(tail(sent))[1:]
+    yield b']' + (b',' + suffix if suffix != b'}' else suffix) + b'\n'
+  return Response(stream_with_context(generate()), mimetype='application/json')
@@ -0,0 +1,361 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right
+from flask import current_app, g, has_app_context, has_request_context
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from models import Question, Category
+from .changes import VersionFile, on_version_bump
+from .category_cache import CATEGORY_VERSION_FILE
+from .pagination import encode_cursor
+from .quiz import QUESTION_VERSION_FILE
+from .replicas import on_primary
+from .serialization import question_rows
+
+SNAPSHOT_ENABLED = False
+SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), 'trivia_snapshot.bin')
+# seconds a generation is used at most, for writes the version files never see (other hosts, manual SQL)
+SNAPSHOT_TTL = 300
+
+MAGIC = b'TRVS'
+FORMAT_VERSION = 1
+# magic, format, question version, category version, questions, category ranges, categories
+HEADER = struct.Struct('<4sIqqqqq')
+HEADER_SIZE = 64
+# stands for NULL in the integer columns
+NULL = -2 ** 63
+
+
+def _null(value):
+  return None if value == NULL else value
+
+
+'''
+write_snapshot(path, rows, categories, versions)
+    writes a snapshot of rows (question_rows() tuples in id order), categories ({id: type}) and the
+    (question, category) versions they were read at. it is written to a temporary file and renamed
+    over path, so a reader maps either the old generation or the new one, never a partial file.
+
+    the file is a header, then arrays of native 64-bit integers, then one UTF-8 blob:
+      ids, categories and difficulties of the questions, in id order
+      offsets of each question's text and answer in the blob (2n + 1)
+      question positions ordered by (category, id), and per category the range of that order
+      category ids and offsets of their types in the blob (c + 1)
+    workers on the same host map it read-only, so it is shared through the page cache.
+'''
+def write_snapshot(path, rows, categories, versions):
+  ids, question_categories, difficulties = array('q'), array('q'), array('q')
+  texts = array('q', [0])
+  blob = bytearray()
+  for question_id, question, answer, category, difficulty in rows:
+    ids.append(question_id)
+    question_categories.append(NULL if category is None else category)
+    difficulties.append(NULL if difficulty is None else difficulty)
+    for text in (question, answer):
+      blob += (text or '').encode('utf-8')
+      texts.append(len(blob))
+  order = array('q', sorted((p for p in range(len(ids)) if question_categories[p] != NULL),
+                            key=lambda p: (question_categories[p], ids[p])))
+  range_categories, range_starts, range_ends = array('q'), array('q'), array('q')
+  for position, question_position in enumerate(order):
+    category = question_categories[question_position]
+    if not range_categories or range_categories[-1] != category:
+      range_categories.append(category)
+      range_starts.append(position)
+      range_ends.append(position)
+    range_ends[-1] = position + 1
+  category_ids = array('q')
+  category_texts = array('q', [len(blob)])
+  for category_id in sorted(categories):
+    category_ids.append(category_id)
+    blob += (categories[category_id] or '').encode('utf-8')
+    category_texts.append(len(blob))
+
+  header = HEADER.pack(MAGIC, FORMAT_VERSION, versions[0], versions[1], len(ids), len(range_categories),
+                       len(category_ids))
+  directory = os.path.dirname(os.path.abspath(path))
+  descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.trivia_snapshot.')
+  try:
+    with os.fdopen(descriptor, 'wb') as output:
+      output.write(header.ljust(HEADER_SIZE, b'\0'))
+      for section in (ids, question_categories, difficulties, texts, order, range_categories, range_starts,
+                      range_ends, category_ids, category_texts):
+        output.write(section.tobytes())
+      output.write(blob)
+      output.flush()
+      os.fsync(output.fileno())
+    os.replace(temporary, path)
+  except BaseException:
+    os.unlink(temporary)
+    raise
+
+
+'''
+Snapshot
+    one generation of the snapshot file, mapped read-only. the arrays are memoryviews of the map,
+    nothing is copied until a row is read. rows are question_rows() tuples.
+'''
+class Snapshot(object):
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      # when the generation was exported, it is renamed into place right after it is written
+      self.written_at = os.fstat(f.fileno()).st_mtime
+    view = memoryview(self._map)
+    magic, format_version, question_version, category_version, questions, ranges, categories = \
+      HEADER.unpack_from(view)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+      raise ValueError('not a trivia snapshot: {}'.format(path))
+    self.versions = (question_version, category_version)
+    self._offset = HEADER_SIZE
+
+    def section(count):
+      start = self._offset
+      self._offset += 8 * count
+      return view[start:self._offset].cast('q')
+
+    self.ids = section(questions)
+    self._categories = section(questions)
+    self._difficulties = section(questions)
+    self._texts = section(2 * questions + 1)
+    self._order = section(questions)
+    range_categories, range_starts, range_ends = section(ranges), section(ranges), section(ranges)
+    category_ids, category_texts = section(categories), section(categories + 1)
+    self._blob = view[self._offset:]
+    self._ranges = dict((range_categories[i], (range_starts[i], range_ends[i])) for i in range(ranges))
+    self._category_types = dict((category_ids[i], self._text(category_texts[i], category_texts[i + 1]))
+                                for i in range(categories))
+
+  def _text(self, start, end):
+    return self._blob[start:end].tobytes().decode('utf-8')
+
+  def row(self, position):
+    texts = self._texts
+    return (self.ids[position], self._text(texts[2 * position], texts[2 * position + 1]),
+            self._text(texts[2 * position + 1], texts[2 * position + 2]),
+            _null(self._categories[position]), _null(self._difficulties[position]))
+
+  def categories(self):
+    '''the {id: type} dict of categories, like CategoryCache.get()'''
+    return self._category_types
+
+  def _positions(self, category):
+    '''the question positions of category in id order, every question for None'''
+    if category is None:
+      return range(len(self.ids))
+    start, end = self._ranges.get(category, (0, 0))
+    return self._order[start:end]
+
+  def _after(self, positions, after_id):
+    '''the index in positions of the first question with an id above after_id'''
+    if isinstance(positions, range):
+      return bisect_right(self.ids, after_id)
+    low, high = 0, len(positions)
+    while low < high:
+      middle = (low + high) // 2
+      if self.ids[positions[middle]] <= after_id:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def count(self, category=None):
+    return len(self._positions(category))
+
+  def rows(self, category=None, after_id=None, limit=None):
+    '''the rows of category (None for all) in id order, after after_id, at most limit of them'''
+    positions = self._positions(category)
+    start = self._after(positions, after_id) if after_id is not None else 0
+    end = len(positions) if limit is None else min(start + limit, len(positions))
+    return [self.row(positions[i]) for i in range(start, end)]
+
+  def page(self, category, per_page, page=1, after_id=None):
+    '''the same page and next cursor as paginate_questions() over the questions of category'''
+    positions = self._positions(category)
+    start = self._after(positions, after_id) if after_id is not None else (page - 1) * per_page
+    rows = [self.row(positions[i]) for i in range(start, min(start + per_page + 1, len(positions)))]
+    next_cursor = None
+    if len(rows) > per_page:
+      rows = rows[:per_page]
+      next_cursor = encode_cursor(rows[-1][0])
+    return rows, next_cursor
+
+  def position(self, question_id):
+    position = bisect_left(self.ids, question_id)
+    if position < len(self.ids) and self.ids[position] == question_id:
+      return position
+    return None
+
+  def rows_by_id(self, ids):
+    '''like question_rows_by_id(), {id: row} for the ids that exist'''
+    rows = {}
+    for question_id in ids:
+      position = self.position(question_id)
+      if position is not None:
+        rows[question_id] = self.row(position)
+    return rows
+
+
+'''
+SnapshotStore
+    the snapshot of this host's workers. current() maps the newest generation and returns it while
+    it matches the question and category version files and is younger than ttl seconds, and None
+    otherwise, so callers fall back to the database. the version files only see writes made on this
+    host, the ttl bounds how long other writes stay hidden. after a write, or a read that found the
+    snapshot stale, one worker exports a new generation once the response is sent.
+'''
+class SnapshotStore(object):
+
+  def __init__(self, path=SNAPSHOT_PATH, question_version_file=QUESTION_VERSION_FILE,
+               category_version_file=CATEGORY_VERSION_FILE, ttl=SNAPSHOT_TTL):
+    self.path = path
+    self.ttl = ttl
+    self.question_version = VersionFile(question_version_file)
+    self.category_version = VersionFile(category_version_file)
+    self.app = None
+    self._snapshot = None
+    self._identity = None
+    self._lock = threading.Lock()
+    _stores.add(self)
+
+  def init_app(self, app):
+    self.app = app
+    app.snapshots = self
+    app.after_request(self._after_request)
+
+  def versions(self):
+    return (self.question_version.value(), self.category_version.value())
+
+  def _map(self):
+    '''maps the file on disk when it is a generation this worker has not mapped yet'''
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      return self._snapshot
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if identity != self._identity:
+      try:
+        self._snapshot = Snapshot(self.path)
+      except (OSError, ValueError):
+        self._snapshot = None
+      # the previous generation is unmapped once the requests still reading it are done
+      self._identity = identity
+    return self._snapshot
+
+  def _fresh(self, snapshot, versions):
+    return (snapshot is not None and snapshot.versions == versions
+            and time.time() - snapshot.written_at < self.ttl)
+
+  def current(self):
+    '''the snapshot if it is up to date, or None'''
+    versions = self.versions()
+    snapshot = self._snapshot
+    if self._fresh(snapshot, versions):
+      return snapshot
+    with self._lock:
+      snapshot = self._map()
+    if self._fresh(snapshot, versions):
+      return snapshot
+    self._stale()
+    return None
+
+  def publish(self):
+    '''
+    exports both tables as a new generation unless the one on disk is current or another worker
+    is exporting already. returns whether it wrote one
+    '''
+    with self._publishing() as locked:
+      if not locked:
+        return False
+      versions = self.versions()
+      with self._lock:
+        snapshot = self._map()
+      if self._fresh(snapshot, versions):
+        return False
+      # read after the versions, so a write committed meanwhile leaves this generation stale
+      with on_primary():
+        rows = question_rows(Question.query).order_by(Question.id).all()
+        categories = dict(Category.query.with_entities(Category.id, Category.type).all())
+      write_snapshot(self.path, rows, categories, versions)
+      return True
+
+  def _publishing(self):
+    return _PublishLock(self.path + '.lock')
+
+  def _stale(self):
+    if not has_app_context() or current_app._get_current_object() is not self.app:
+      return
+    if has_request_context():
+      g.snapshot_stale = True
+    else:
+      self.publish()
+
+  def _after_request(self, response):
+    if g.pop('snapshot_stale', False):
+      response.call_on_close(self._publish_in_context)
+    return response
+
+  def _publish_in_context(self):
+    try:
+      with self.app.app_context():
+        self.publish()
+    except Exception:
+      self.app.logger.exception('could not publish the question snapshot')
+
+
+'''
+_PublishLock
+    an exclusive, non-blocking lock file around an export, so workers that all notice a stale
+    snapshot at once export it once. without fcntl only the threads of one worker are serialized.
+'''
+class _PublishLock(object):
+
+  _threads = threading.Lock()
+
+  def __init__(self, path):
+    self.path = path
+    self._file = None
+    self._locked = False
+
+  def __enter__(self):
+    self._locked = self._threads.acquire(False)
+    if self._locked and fcntl is not None:
+      self._file = open(self.path, 'a')
+      try:
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        self._file.close()
+        self._file = None
+        self._threads.release()
+        self._locked = False
+    return self._locked
+
+  def __exit__(self, *exc_info):
+    if self._file is not None:
+      fcntl.flock(self._file, fcntl.LOCK_UN)
+      self._file.close()
+    if self._locked:
+      self._threads.release()
+
+
+_stores = weakref.WeakSet()
+
+
+def _changed():
+  for store in list(_stores):
+    store._stale()
+
+
+on_version_bump(Question, _changed)
+on_version_bump(Category, _changed)
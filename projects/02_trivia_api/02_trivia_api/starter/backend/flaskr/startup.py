@@ -0,0 +1,60 @@
+import time
+
+from .changes import VersionedIndex
+
+# load the in-memory indexes while the app is created, before the worker takes traffic
+PRELOAD_CACHES = False
+
+
+'''
+StartupReport
+    how long a cold start took: importing flaskr, then each phase of create_app() between
+    mark() calls, plus whatever else was noted (create_all, preloaded indexes)
+'''
+class StartupReport(object):
+
+  def __init__(self, import_seconds=None):
+    self.import_seconds = import_seconds
+    self.phases = []
+    self.notes = {}
+    self._started = self._last = time.perf_counter()
+
+  def mark(self, phase):
+    '''ends phase, timed from the previous mark or from the start'''
+    now = time.perf_counter()
+    self.phases.append((phase, now - self._last))
+    self._last = now
+
+  def note(self, key, value):
+    self.notes[key] = value
+
+  def as_dict(self):
+    report = dict(self.notes)
+    report['importSeconds'] = round(self.import_seconds, 6) if self.import_seconds is not None else None
+    report['phases'] = [{'phase': phase, 'seconds': round(seconds, 6)} for phase, seconds in self.phases]
+    report['createAppSeconds'] = round(self._last - self._started, 6)
+    return report
+
+  def summary(self):
+    '''one log line'''
+    parts = ['{} {:.1f}ms'.format(phase, seconds * 1000) for phase, seconds in self.phases]
+    if self.import_seconds is not None:
+      parts.insert(0, 'import {:.1f}ms'.format(self.import_seconds * 1000))
+    return 'startup: ' + ', '.join(parts)
+
+
+'''
+preload_caches(app, caches)
+    loads each (name, index) of caches that is a VersionedIndex now, so the first requests
+    do not pay for it. returns {name: seconds}
+'''
+def preload_caches(app, caches):
+  timings = {}
+  with app.app_context():
+    for name, cache in caches:
+      if not isinstance(cache, VersionedIndex):
+        continue
+      start = time.perf_counter()
+      cache.data()
+      timings[name] = round(time.perf_counter() - start, 6)
+  return timings
@@ -0,0 +1,94 @@
+from sqlalchemy import func
+
+from models import db, Question
+from .changes import VersionedIndex
+from .quiz import QUESTION_VERSION_FILE
+
+STATS_TTL = 300
+
+
+def _int_or_none(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+
+
+'''
+tally(rows)
+    {(category, difficulty): count} from (category, difficulty, count) rows of a GROUP BY
+'''
+def tally(rows):
+  counts = {}
+  for category, difficulty, count in rows:
+    key = (_int_or_none(category), _int_or_none(difficulty))
+    counts[key] = counts.get(key, 0) + count
+  return counts
+
+
+'''
+summarize(items, categories)
+    totals and difficulty histograms of ((category, difficulty), count) items, overall and for
+    each of categories ({id: type})
+'''
+def summarize(items, categories):
+  result = {
+    'totalQuestions': 0,
+    'difficulties': {},
+    'categories': dict((category_id, {'type': type, 'totalQuestions': 0, 'difficulties': {}})
+                       for category_id, type in categories.items())
+  }
+  for (category, difficulty), count in items:
+    result['totalQuestions'] += count
+    if difficulty is not None:
+      result['difficulties'][difficulty] = result['difficulties'].get(difficulty, 0) + count
+    entry = result['categories'].get(category)
+    if entry is not None:
+      entry['totalQuestions'] += count
+      if difficulty is not None:
+        entry['difficulties'][difficulty] = entry['difficulties'].get(difficulty, 0) + count
+  return result
+
+
+'''
+QuestionStats
+    the number of questions per (category, difficulty), built with one GROUP BY and then kept
+    current by counting this worker's inserts and deletes, so totals and histograms cost a
+    dict lookup instead of a COUNT over the table.
+    questions without a category count towards the total only.
+'''
+class QuestionStats(VersionedIndex):
+
+  model = Question
+
+  def __init__(self, ttl=STATS_TTL, version_file=QUESTION_VERSION_FILE):
+    super(QuestionStats, self).__init__(ttl, version_file)
+
+  def load(self):
+    return tally(db.session.query(Question.category, Question.difficulty, func.count(Question.id))
+                 .group_by(Question.category, Question.difficulty))
+
+  def apply(self, counts, changes):
+    for operation, row in changes:
+      if operation == 'update':
+        # the row's previous category and difficulty are not known, count again
+        return False
+      key = (_int_or_none(row['category']), _int_or_none(row['difficulty']))
+      counts[key] = counts.get(key, 0) + (1 if operation == 'insert' else -1)
+      if not counts[key]:
+        del counts[key]
+    return True
+
+  def count(self, category=None):
+    '''the number of questions in the category, or in total when category is None'''
+    counts = self.data()
+    with self._lock:
+      return sum(n for (question_category, difficulty), n in counts.items()
+                 if category is None or question_category == category)
+
+  def summary(self, categories):
+    '''totals and difficulty histograms, overall and for each of categories ({id: type})'''
+    counts = self.data()
+    with self._lock:
+      items = list(counts.items())
+    return summarize(items, categories)
@@ -0,0 +1,124 @@
+import base64
+import heapq
+import json
+import time
+from sqlalchemy import and_, or_
+
+from models import db, Question, QuestionTombstone, SyncVersion
+from .changes import VersionFile
+from .quiz import QUESTION_VERSION_FILE
+from .serialization import QUESTION_COLUMNS, format_row
+
+CHANGES_PER_PAGE = 500
+# server-sent events: how often a stream checks for writes, sends a comment to keep proxies from
+# closing it, and how long it lasts before the client reconnects with Last-Event-ID
+SYNC_POLL_INTERVAL_MS = 1000
+SYNC_KEEPALIVE_SECONDS = 15
+SYNC_STREAM_SECONDS = 300
+
+
+'''
+encode_sync_cursor(version, after_id, upto) / decode_sync_cursor(cursor)
+    the position inside one sync, after the change (version, after_id) and up to version upto.
+    decode raises ValueError for anything that is not one of ours
+'''
+def encode_sync_cursor(version, after_id, upto):
+  raw = json.dumps({'version': version, 'after_id': after_id, 'upto': upto}).encode('utf-8')
+  return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_sync_cursor(cursor):
+  try:
+    raw = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    return int(raw['version']), int(raw['after_id']), int(raw['upto'])
+  except (ValueError, TypeError, KeyError):
+    raise ValueError('invalid cursor')
+
+
+'''
+current_sync_version()
+    the highest committed sync version, 0 before the first write
+'''
+def current_sync_version():
+  return db.session.query(SyncVersion.version).filter(SyncVersion.id == 1).scalar() or 0
+
+
+def _after(version_column, id_column, version, after_id, upto):
+  if after_id is None:
+    position = version_column > version
+  else:
+    position = or_(version_column > version, and_(version_column == version, id_column > after_id))
+  return and_(position, version_column <= upto)
+
+
+'''
+changes_since(since, cursor, limit)
+    one page of the changes after version since (or after cursor), in version order:
+    {'type': 'upsert', 'version', 'question'} for inserts and updates, {'type': 'delete', 'version', 'id'}
+    for deletes. returns the changes, the version the client is at once it has every page, and the
+    cursor of the next page (None on the last). the upper bound is read first and kept in the cursor,
+    so writes committed during a sync wait for the next one instead of tearing this one.
+'''
+def changes_since(since=0, cursor=None, limit=CHANGES_PER_PAGE):
+  after_id = None
+  if cursor is not None:
+    since, after_id, upto = decode_sync_cursor(cursor)
+  else:
+    upto = current_sync_version()
+  upserts = db.session.query(Question.version, *QUESTION_COLUMNS) \
+    .filter(_after(Question.version, Question.id, since, after_id, upto)) \
+    .order_by(Question.version, Question.id).limit(limit + 1).all()
+  deletes = db.session.query(QuestionTombstone.version, QuestionTombstone.question_id) \
+    .filter(_after(QuestionTombstone.version, QuestionTombstone.question_id, since, after_id, upto)) \
+    .order_by(QuestionTombstone.version, QuestionTombstone.question_id).limit(limit + 1).all()
+  merged = list(heapq.merge(((row[0], row[1], 'upsert', row) for row in upserts),
+                            ((row[0], row[1], 'delete', row) for row in deletes)))
+  next_cursor = None
+  if len(merged) > limit:
+    merged = merged[:limit]
+    next_cursor = encode_sync_cursor(merged[-1][0], merged[-1][1], upto)
+  changes = []
+  for version, question_id, kind, row in merged:
+    if kind == 'upsert':
+      changes.append({'type': 'upsert', 'version': version, 'question': format_row(row[1:])})
+    else:
+      changes.append({'type': 'delete', 'version': version, 'id': question_id})
+  return changes, upto, next_cursor
+
+
+'''
+stream_changes(since, poll_interval_ms, keepalive_seconds, stream_seconds, version_file)
+    server-sent events with the changes after since: one "changes" event per page, the last page of
+    a sync carrying the version as its event id. it looks for writes with a stat() of the question
+    version file, and only queries the database when that moved. the database connection is handed
+    back between polls, so idle streams do not hold on to the pool
+'''
+def stream_changes(since, poll_interval_ms=SYNC_POLL_INTERVAL_MS, keepalive_seconds=SYNC_KEEPALIVE_SECONDS,
+                   stream_seconds=SYNC_STREAM_SECONDS, version_file=QUESTION_VERSION_FILE):
+  version_file = VersionFile(version_file)
+  started = last_sent = time.time()
+  seen = None
+  yield 'retry: {}\n\n'.format(poll_interval_ms)
+  while True:
+    marker = version_file.value()
+    if marker != seen:
+      seen = marker
+      cursor = None
+      while True:
+        changes, upto, cursor = changes_since(since, cursor)
+        if changes or cursor is None and upto != since:
+          event = 'event: changes\n'
+          if cursor is None:
+            event += 'id: {}\n'.format(upto)
+          yield event + 'data: {}\n\n'.format(json.dumps({'changes': changes, 'version': upto}))
+          last_sent = time.time()
+        if cursor is None:
+          break
+      since = upto
+      db.session.close()
+    elif time.time() - last_sent >= keepalive_seconds:
+      yield ': keepalive\n\n'
+      last_sent = time.time()
+    if time.time() - started >= stream_seconds:
+      return
+    time.sleep(poll_interval_ms / 1000.0)
@@ -0,0 +1,73 @@
+"""category as an indexed integer foreign key, indexes for difficulty and id paging
+
+Brings both kinds of existing databases to the schema of models.py:
+- restored from trivia.psql: category is already an integer with a foreign key,
+  only the indexes are missing
+- created by db.create_all() from the old models: category is a varchar without
+  a foreign key, so its values are cast to integers first
+
+Values that are not a number, or name a category that does not exist, become NULL,
+which is what the foreign key does on its own when a category is deleted. Every step
+checks the current schema first, so databases created by the new create_all() are
+left as they are.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_questions_category_id', ['category', 'id']),
+    ('ix_questions_category_difficulty', ['category', 'difficulty']),
+    ('ix_questions_difficulty', ['difficulty']),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    columns = dict((column['name'], column) for column in inspector.get_columns('questions'))
+    has_foreign_key = any(key['constrained_columns'] == ['category']
+                          for key in inspector.get_foreign_keys('questions'))
+
+    if not isinstance(columns['category']['type'], sa.Integer):
+        if bind.dialect.name == 'postgresql':
+            op.execute("UPDATE questions SET category = NULL WHERE category !~ '^\\s*[0-9]+\\s*$'")
+        else:
+            op.execute("UPDATE questions SET category = NULL WHERE trim(category) = '' "
+                       "OR trim(category) GLOB '*[^0-9]*'")
+    op.execute('UPDATE questions SET category = NULL WHERE category IS NOT NULL '
+               'AND CAST(category AS INTEGER) NOT IN (SELECT id FROM categories)')
+
+    if not isinstance(columns['category']['type'], sa.Integer) or not has_foreign_key:
+        # SQLite cannot alter columns in place, batch mode copies the table there
+        with op.batch_alter_table('questions') as batch:
+            if not isinstance(columns['category']['type'], sa.Integer):
+                batch.alter_column('category', type_=sa.Integer(), existing_type=columns['category']['type'],
+                                   postgresql_using='trim(category)::integer')
+            if not has_foreign_key:
+                batch.create_foreign_key('questions_category_fkey', 'categories', ['category'], ['id'],
+                                         onupdate='CASCADE', ondelete='SET NULL')
+
+    existing = set(index['name'] for index in sa.inspect(bind).get_indexes('questions'))
+    for name, index_columns in INDEXES:
+        if name not in existing:
+            op.create_index(name, 'questions', index_columns)
+
+
+def downgrade():
+    # the column type and foreign key stay, trivia.psql databases had them before this revision
+    existing = set(index['name'] for index in sa.inspect(op.get_bind()).get_indexes('questions'))
+    for name, index_columns in reversed(INDEXES):
+        if name in existing:
+            op.drop_index(name, table_name='questions')
@@ -0,0 +1,68 @@
+"""sync versions and tombstones for delta sync of questions
+
+Adds questions.version, the question_tombstones table and the one-row sync_version
+counter they are numbered from. Existing questions all get version 1, so a client
+syncing from version 0 receives every one of them. Every step checks the current
+schema first, so databases created by the new create_all() are left as they are.
+The counter is raised to the highest version in use even when the table was already
+there, or the next write would reuse a version clients have synced past.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 18:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = inspector.get_table_names()
+
+    if 'version' not in [column['name'] for column in inspector.get_columns('questions')]:
+        with op.batch_alter_table('questions') as batch:
+            batch.add_column(sa.Column('version', sa.BigInteger(), nullable=True))
+        op.execute('UPDATE questions SET version = 1')
+    if 'ix_questions_version' not in [index['name'] for index in inspector.get_indexes('questions')]:
+        op.create_index('ix_questions_version', 'questions', ['version'])
+
+    if 'question_tombstones' not in tables:
+        op.create_table(
+            'question_tombstones',
+            sa.Column('question_id', sa.Integer(), primary_key=True),
+            sa.Column('version', sa.BigInteger(), nullable=False),
+        )
+        op.create_index('ix_question_tombstones_version', 'question_tombstones', ['version'])
+
+    if 'sync_version' not in tables:
+        op.create_table(
+            'sync_version',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('version', sa.BigInteger(), nullable=False),
+        )
+
+    highest = max(bind.execute('SELECT coalesce(max(version), 0) FROM questions').scalar(),
+                  bind.execute('SELECT coalesce(max(version), 0) FROM question_tombstones').scalar())
+    if bind.execute('SELECT count(*) FROM sync_version WHERE id = 1').scalar():
+        op.execute(sa.text('UPDATE sync_version SET version = :highest WHERE id = 1 AND version < :highest')
+                   .bindparams(highest=highest))
+    else:
+        op.execute(sa.text('INSERT INTO sync_version (id, version) VALUES (1, :highest)').bindparams(highest=highest))
+
+
+def downgrade():
+    op.drop_table('sync_version')
+    op.drop_index('ix_question_tombstones_version', table_name='question_tombstones')
+    op.drop_table('question_tombstones')
+    op.drop_index('ix_questions_version', table_name='questions')
+    with op.batch_alter_table('questions') as batch:
+        batch.drop_column('version')
@@ -1,6 +1,9 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey, Index, create_engine, event, func, inspect, select
+from sqlalchemy import orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_host = os.getenv('database_host', 'localhost:5432')
@@ -9,18 +12,130 @@ database_password = os.getenv('database_password', 'Gofran_333')
 database_name = os.getenv('database_name', 'trivia')
 database_path = 'postgresql+psycopg2://{}:{}@{}/{}'.format(database_user, database_password, database_host, database_name)
 
-db = SQLAlchemy()
+# the Alembic head these models match, bump it with every new revision in migrations/versions
+SCHEMA_VERSION = '0002'
+# 'auto' runs create_all() unless the database is already at SCHEMA_VERSION, or 'always' / 'never'
+CREATE_TABLES = 'auto'
+
+'''
+RoutingSession
+    asks the app's replica router, when it has one, which engine a statement goes to
+'''
+class RoutingSession(SignallingSession):
+
+  def get_bind(self, mapper=None, clause=None):
+    router = getattr(self.app, 'replica_router', None)
+    if router is not None:
+      engine = router.get_bind(self, clause)
+      if engine is not None:
+        return engine
+    return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+'''
+schema_version(app)
+    the Alembic revision the app's database is at, or None when it was never migrated
+'''
+def schema_version(app):
+    try:
+        with db.get_engine(app).connect() as connection:
+            return connection.execute('SELECT version_num FROM alembic_version').scalar()
+    except Exception:
+        return None
+
+'''
+check_schema(app, version)
+    raises RuntimeError when the database at Alembic revision version (None when never migrated)
+    does not match these models: migrated to an older revision, or never migrated but with tables
+    missing their columns, as after restoring trivia.psql. create_all() only adds missing tables,
+    so the app would otherwise start and fail on its first query. an empty database passes
+'''
+def check_schema(app, version):
+    if version is not None:
+        if version < SCHEMA_VERSION:
+            raise RuntimeError('the database is at schema revision {}, these models need {}: '
+                               'run flask db upgrade'.format(version, SCHEMA_VERSION))
+        if version != SCHEMA_VERSION:
+            raise RuntimeError('the database is at schema revision {}, newer than the {} these models '
+                               'need: deploy the code matching the database'.format(version, SCHEMA_VERSION))
+        return
+    inspector = inspect(db.get_engine(app))
+    existing = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name in existing:
+            columns = set(column['name'] for column in inspector.get_columns(table.name))
+            missing.extend('{}.{}'.format(table.name, column.name) for column in table.columns
+                           if column.name not in columns)
+    if missing:
+        raise RuntimeError('the database was never migrated and lacks {}: run flask db upgrade'
+                           .format(', '.join(missing)))
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    engine_options, when given, are passed on to create_engine (pool sizing, timeouts).
+    create_tables is one of CREATE_TABLES' modes; 'auto' skips reflecting every table for
+    create_all() when the database is already migrated to SCHEMA_VERSION.
+    with require_schema, a database behind these models stops the app, see check_schema();
+    the migrations turn it off to be able to upgrade that database.
+    returns whether create_all() ran
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, engine_options=None, create_tables=CREATE_TABLES,
+             require_schema=True):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if engine_options is not None:
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     db.app = app
     db.init_app(app)
+    if create_tables not in ('auto', 'always', 'never'):
+        raise ValueError('unknown create_tables mode: {}'.format(create_tables))
+    version = schema_version(app)
+    if require_schema:
+        check_schema(app, version)
+    if create_tables == 'never' or (create_tables == 'auto' and version == SCHEMA_VERSION):
+        return False
     db.create_all()
+    return True
+
+'''
+sync_version(connection)
+    the change version of the transaction on connection, for delta sync. the transaction's first
+    write increments the one-row sync_version counter, whose row lock is held until commit, so
+    versions become visible in commit order and every row a transaction writes shares its version
+'''
+def sync_version(connection):
+    version = connection.info.get('sync_version')
+    if version is None:
+        counter = SyncVersion.__table__
+        updated = connection.execute(counter.update().where(counter.c.id == 1).values(version=counter.c.version + 1))
+        if updated.rowcount == 0:
+            connection.execute(counter.insert().values(id=1, version=1))
+        version = connection.execute(select([counter.c.version]).where(counter.c.id == 1)).scalar()
+        connection.info['sync_version'] = version
+    return version
+
+def _sync_version_default(context):
+    return sync_version(context.connection)
+
+# connection.info outlives the transaction, forget its version when it ends
+@event.listens_for(Engine, 'commit')
+@event.listens_for(Engine, 'rollback')
+def _forget_sync_version(connection):
+    connection.info.pop('sync_version', None)
+
+@event.listens_for(Pool, 'reset')
+def _forget_sync_version_on_reset(dbapi_connection, connection_record):
+    connection_record.info.pop('sync_version', None)
 
 '''
 Question
@@ -28,12 +143,20 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # keep in step with migrations/versions, create_all() builds new databases from these
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+    Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    Index('ix_questions_difficulty', 'difficulty'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
+  # sync version of the last insert or update, set on every write including bulk inserts
+  version = Column(BigInteger, default=_sync_version_default, onupdate=_sync_version_default, index=True)
 
   def __init__(self, question, answer, category, difficulty):
     self.question = question
@@ -41,16 +164,18 @@ class Question(db.Model):
     self.category = category
     self.difficulty = difficulty
 
-  def insert(self):
+  def insert(self, commit=True):
     db.session.add(self)
-    db.session.commit()
+    if commit:
+      db.session.commit()
   
   def update(self):
     db.session.commit()
 
-  def delete(self):
+  def delete(self, commit=True):
     db.session.delete(self)
-    db.session.commit()
+    if commit:
+      db.session.commit()
 
   def format(self):
     return {
@@ -74,8 +199,70 @@ class Category(db.Model):
   def __init__(self, type):
     self.type = type
 
+  def insert(self):
+    db.session.add(self)
+    db.session.commit()
+
+  def update(self):
+    db.session.commit()
+
+  def delete(self):
+    db.session.delete(self)
+    db.session.commit()
+
   def format(self):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+QuestionTombstone
+    the id and sync version of a deleted question, so delta sync can report deletes
+'''
+class QuestionTombstone(db.Model):
+  __tablename__ = 'question_tombstones'
+
+  question_id = Column(Integer, primary_key=True)
+  version = Column(BigInteger, nullable=False, index=True)
+
+
+@event.listens_for(Question, 'after_delete')
+def _record_tombstone(mapper, connection, target):
+  tombstones = QuestionTombstone.__table__
+  version = sync_version(connection)
+  connection.execute(tombstones.delete().where(tombstones.c.question_id == target.id))
+  connection.execute(tombstones.insert().values(question_id=target.id, version=version))
+
+
+'''
+SyncVersion
+    the single row counting sync versions, see sync_version()
+'''
+class SyncVersion(db.Model):
+  __tablename__ = 'sync_version'
+
+  id = Column(Integer, primary_key=True)
+  version = Column(BigInteger, nullable=False)
+
+
+'''
+seed_sync_version(connection)
+    makes sure the sync_version row exists and counts at least to the highest version already
+    given to a question or tombstone, so the next write gets a version no client has seen.
+    migration 0002 does the same for upgraded databases
+'''
+def seed_sync_version(connection):
+    counter = SyncVersion.__table__
+    highest = max(connection.execute(select([func.coalesce(func.max(Question.__table__.c.version), 0)])).scalar(),
+                  connection.execute(select([func.coalesce(func.max(QuestionTombstone.__table__.c.version), 0)])).scalar())
+    current = connection.execute(select([counter.c.version]).where(counter.c.id == 1)).scalar()
+    if current is None:
+        connection.execute(counter.insert().values(id=1, version=highest))
+    elif current < highest:
+        connection.execute(counter.update().where(counter.c.id == 1).values(version=highest))
+
+# on the metadata, not the table: it runs once every table of a create_all() exists
+@event.listens_for(db.metadata, 'after_create')
+def _seed_sync_version(target, connection, **kw):
+    seed_sync_version(connection)